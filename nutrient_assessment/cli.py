@@ -0,0 +1,217 @@
+"""
+montenegro-burke-ms/nutrient_assessment/cli.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Single command line entry point for the nutrient_assessment tools.
+
+    python cli.py untargeted [--file PATH] [--output PATH] [--log2-weight W] [--compact]
+    python cli.py timsTOF [--file PATH] [--output PATH] [--n N] [--log2-weight W] [--no-cache]
+    python cli.py small-molecule [--file PATH] [--output PATH] [--collapse-isotopes] [--no-cache]
+    python cli.py fragmentation --file PATH --precursor MZ
+    python cli.py reconcile [--qtof-file PATH] [--tims-file PATH] [--ppm PPM] [--rt-window MIN]
+    python cli.py validate PATH [PATH ...]
+    python cli.py watch --input-dir PATH
+
+Only the standard library is imported at startup. pandas, numpy and the
+pipeline modules are imported inside the subcommand that runs them, so
+`--help` and `validate` return without paying for them.
+
+Pipeline stage results are memoized in nutrient_assessment/.cache (see
+`result_cache`), so re-running an export with the same settings is instant.
+"""
+
+import argparse
+import importlib.util
+import os
+import sys
+
+import result_cache
+import watch_service
+
+BASE_PATH = os.path.abspath(os.path.dirname(__file__))
+DATA_PATH = os.path.join(BASE_PATH, "data")
+FRAGMENTATION_PATH = os.path.join(os.path.dirname(BASE_PATH), "fragmentation_peaks")
+
+# Subcommand -> (pipeline module, default input file, default output file)
+PIPELINES = {
+    "untargeted": (
+        "main_untargeted_rectified",
+        "exportFile_irahorecka_yeast_nutrient_array_350milliminute_retention_time.csv",
+        "log2_nutrient_mean.csv",
+    ),
+    "timsTOF": (
+        "main_timsTOF_rectified",
+        "20211104_IH_timsTOF_Experiment.csv",
+        "log2_nutrient_mean_timsTOF.csv",
+    ),
+    "small-molecule": (
+        "main_small_molecule_rectified",
+        "exportFile_irahorecka_yeast_nutrient_array_batch_recursive_small_molecule_350milliminute_retention_time.csv",
+        "log2_nutrient_mean_small_molecule.csv",
+    ),
+}
+
+
+def run_pipeline(args):
+    """Runs pipeline of `args.command` and writes log2 nutrient means to `args.output`."""
+    module_name, _, _ = PIPELINES[args.command]
+    pipeline = importlib.import_module(module_name)
+    cache = None
+    if not args.no_cache:
+        cache = result_cache.ResultCache(args.cache_dir, max_bytes=args.cache_max_mb << 20)
+    params = {
+        param: getattr(args, param)
+        for param in (
+            "chunk_size",
+            "n",
+            "log2_weight",
+            "range_min",
+            "range_max",
+            "collapse_isotopes",
+            "isotope_ppm",
+            "isotope_rt_window",
+            "compact",
+        )
+        if getattr(args, param, None) is not None
+    }
+    norm_agg_nutrient_mean_log2 = pipeline.get_norm_agg_nutrient_mean_log2(
+        args.file, cache=cache, **params
+    )
+    norm_agg_nutrient_mean_log2.to_csv(args.output)
+    print(f"Wrote {norm_agg_nutrient_mean_log2.shape[1]} metabolites to {args.output}")
+
+
+def run_fragmentation(args):
+    """Prints fragmentation peaks below `args.precursor`, sorted by abundance."""
+    # fragmentation_peaks ships its own `dataproc` package - load it under another name
+    # so it cannot shadow nutrient_assessment's `dataproc`
+    spec = importlib.util.spec_from_file_location(
+        "fragmentation_dataproc", os.path.join(FRAGMENTATION_PATH, "dataproc", "__init__.py")
+    )
+    fragmentation_dataproc = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(fragmentation_dataproc)
+
+    df = fragmentation_dataproc.read_csv(args.file)
+    df_non_nan = fragmentation_dataproc.rm_empty_cols(df)
+    print(
+        fragmentation_dataproc.sort_abundance_below_precursor(
+            df_non_nan,
+            abundance_colname="Abund",
+            precursor_colname="m/z",
+            precursor_value=args.precursor,
+            ascending=False,
+        )
+    )
+
+
+def run_reconcile(args):
+    """Joins qTOF and timsTOF fold changes, prints per-condition summary, writes pairs."""
+    import main_reconcile
+
+    cache = None
+    if not args.no_cache:
+        cache = result_cache.ResultCache(args.cache_dir, max_bytes=args.cache_max_mb << 20)
+    pairs, summary = main_reconcile.reconcile_qtof_and_timstof(
+        args.qtof_file,
+        args.tims_file,
+        ppm=args.ppm,
+        rt_window=args.rt_window,
+        log2_weight=args.log2_weight,
+        cache=cache,
+    )
+    print(summary)
+    pairs.to_csv(args.output, index=False)
+
+
+def run_validate(args):
+    """Reports the detected export format of each file. Exits 1 if any is unrecognized."""
+    is_valid = True
+    for path in args.paths:
+        export_format = watch_service.get_export_format(path)
+        print(f"{path}: {export_format or 'unrecognized'}")
+        is_valid &= export_format is not None
+    return 0 if is_valid else 1
+
+
+def add_cache_arguments(parser):
+    parser.add_argument("--no-cache", action="store_true", help="Don't memoize stages")
+    parser.add_argument("--cache-dir", default=result_cache.CACHE_PATH)
+    parser.add_argument("--cache-max-mb", type=int, default=1024)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog="cli.py", description="Nutrient array LC-MS data processing tools."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for command, (module_name, input_name, output_name) in PIPELINES.items():
+        subparser = subparsers.add_parser(
+            command, help=f"Run {module_name}.py and write log2 nutrient means"
+        )
+        subparser.add_argument("--file", default=os.path.join(DATA_PATH, input_name))
+        subparser.add_argument("--output", default=os.path.join(DATA_PATH, output_name))
+        # Unset parameters fall back to the pipeline's defaults
+        subparser.add_argument("--chunk-size", type=int, help="Samples per biological replicate")
+        if command == "timsTOF":
+            subparser.add_argument("--n", type=int, help="Min valid reads among 4 samples")
+        subparser.add_argument("--log2-weight", type=float, help="Min log2 fold change")
+        subparser.add_argument("--range-min", type=float, help="Min kept log2 value")
+        subparser.add_argument("--range-max", type=float, help="Max kept log2 value")
+        subparser.add_argument(
+            "--compact",
+            action="store_true",
+            default=None,
+            help="Hold intensities as float32 / sparse (see dataproc.compact)",
+        )
+        if command != "untargeted":
+            # untargeted features are named compounds, not "mass_RT" labels
+            subparser.add_argument(
+                "--collapse-isotopes",
+                action="store_true",
+                default=None,
+                help="Keep one feature per isotope / adduct group",
+            )
+            subparser.add_argument("--isotope-ppm", type=float, help="Max isotope mass error")
+            subparser.add_argument(
+                "--isotope-rt-window", type=float, help="Max isotope RT difference (min)"
+            )
+        add_cache_arguments(subparser)
+        subparser.set_defaults(func=run_pipeline)
+
+    subparser = subparsers.add_parser("fragmentation", help="Sort MS/MS fragmentation peaks")
+    subparser.add_argument("--file", required=True, help="Agilent Qualitative Analysis CSV")
+    subparser.add_argument("--precursor", type=float, required=True, help="Precursor m/z")
+    subparser.set_defaults(func=run_fragmentation)
+
+    subparser = subparsers.add_parser("reconcile", help="Compare qTOF and timsTOF fold changes")
+    subparser.add_argument(
+        "--qtof-file", default=os.path.join(DATA_PATH, PIPELINES["untargeted"][1])
+    )
+    subparser.add_argument("--tims-file", default=os.path.join(DATA_PATH, PIPELINES["timsTOF"][1]))
+    subparser.add_argument(
+        "--output", default=os.path.join(DATA_PATH, "reconciled_qTOF_timsTOF.csv")
+    )
+    subparser.add_argument("--ppm", type=float, default=20, help="Max neutral mass difference")
+    subparser.add_argument("--rt-window", type=float, help="Max RT difference (min)")
+    subparser.add_argument("--log2-weight", type=float, default=1, help="Min |log2| of a hit")
+    add_cache_arguments(subparser)
+    subparser.set_defaults(func=run_reconcile)
+
+    subparser = subparsers.add_parser("validate", help="Detect export format of CSV files")
+    subparser.add_argument("paths", nargs="+")
+    subparser.set_defaults(func=run_validate)
+
+    subparser = subparsers.add_parser("watch", help="Process exports as they land")
+    watch_service.add_arguments(subparser)
+    subparser.set_defaults(func=watch_service.run_service)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
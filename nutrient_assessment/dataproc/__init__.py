@@ -1,5 +1,31 @@
 import pandas as pd
 
+from dataproc.untargeted_ms import get_cols_to_keep
+
 
 def read_csv(path, **kwargs):
     return pd.read_csv(path, **kwargs)
+
+
+def read_csv_header(path):
+    """Returns column names of CSV file at `path` without parsing any rows."""
+    return list(pd.read_csv(path, nrows=0))
+
+
+def read_csv_with_cols_to_keep(path, col_substrings, float_col_substrings=None, **kwargs):
+    """Reads only the columns of CSV file at `path` whose names contain any of `col_substrings`.
+    Columns matching `float_col_substrings` are parsed directly as float64."""
+    cols_to_keep = list(dict.fromkeys(get_cols_to_keep(read_csv_header(path), col_substrings)))
+    float_cols = (
+        get_cols_to_keep(cols_to_keep, float_col_substrings) if float_col_substrings else []
+    )
+    # C engine - MassHunter exports hold rows shorter than the header, which the pyarrow
+    # engine rejects (or could only skip)
+    df = pd.read_csv(
+        path,
+        usecols=cols_to_keep,
+        dtype={colname: "float64" for colname in float_cols},
+        **kwargs,
+    )
+    # Restore column order of `col_substrings` - usecols returns columns in file order
+    return df[cols_to_keep]
@@ -0,0 +1,104 @@
+"""
+montenegro-burke-ms/nutrient_assessment/dataproc/annotate.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Groups co-eluting features that are isotopes or adducts of the same
+metabolite (e.g. the 134.0468 / 135.0492 13C pair in the ATP fragmentation
+spectrum), so that each metabolite can be carried through normalization,
+aggregation and clustering as a single representative feature.
+
+For every known mass difference, pairs of features (m, m + difference) within
+`ppm` and `rt_window` are found with the sorted-window join of
+`dataproc.reconcile.join_within_ppm`. Groups are the connected components of
+all pairs.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+import dataproc.compact as cp
+from dataproc.reconcile import join_within_ppm, parse_mz_rt_labels
+
+# Mass differences (Da) between features of the same metabolite - positive ion mode
+MASS_DIFFERENCES = {
+    "13C": 1.003355,
+    "13C2": 2.006710,
+    "NH4-H": 17.026549,
+    "Na-H": 21.981943,
+    "K-H": 37.955882,
+}
+# Isotope differences only - adduct differences do not apply to neutral masses
+ISOTOPE_MASS_DIFFERENCES = {key: MASS_DIFFERENCES[key] for key in ("13C", "13C2")}
+
+
+def group_isotopes_and_adducts(mass, rt, ppm=10, rt_window=0.05, mass_differences=None):
+    """Returns group label of every feature. Features share a group if they are linked by
+    any of `mass_differences` (default MASS_DIFFERENCES) within `ppm` and co-elute within
+    `rt_window` (same unit as `rt`)."""
+    mass = np.asarray(mass, dtype=np.float64)
+    rt = np.asarray(rt, dtype=np.float64)
+    if mass_differences is None:
+        mass_differences = MASS_DIFFERENCES
+
+    pairs = [
+        join_within_ppm(mass + mass_difference, mass, ppm, rt, rt, rt_window=rt_window)
+        for mass_difference in mass_differences.values()
+    ]
+    rows = np.concatenate([left_idx for left_idx, _ in pairs] + [np.zeros(0, dtype=int)])
+    cols = np.concatenate([right_idx for _, right_idx in pairs] + [np.zeros(0, dtype=int)])
+    graph = coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(mass), len(mass)))
+    _, groups = connected_components(graph, directed=False)
+    return groups
+
+
+def get_representative_features(groups, intensity, mass):
+    """Returns bool mask of the representative feature of every group - the most intense,
+    with ties going to the lowest mass (i.e., monoisotopic)."""
+    # Sort by group, then intensity (descending, NaN last), then mass - first of each group wins
+    intensity = np.nan_to_num(np.asarray(intensity, dtype=np.float64), nan=-np.inf)
+    order = np.lexsort((mass, -intensity, groups))
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = groups[order][1:] != groups[order][:-1]
+    is_representative = np.zeros(len(order), dtype=bool)
+    is_representative[order[is_first]] = True
+    return is_representative
+
+
+def get_mean_intensity(df):
+    """Returns mean intensity of every feature of numeric df or CompactMatrix, ignoring
+    missing values."""
+    if isinstance(df, cp.CompactMatrix):
+        n_samples = df.values.shape[0]
+        df_mean = cp.group_and_agg_compact(df, np.zeros(n_samples), "mean")
+        return cp.compact_to_values(df_mean)[0][0]
+    return df.mean(axis=0).to_numpy(dtype=np.float64)
+
+
+def annotate_mz_rt_features(df, ppm=10, rt_window=0.05, mass_differences=None):
+    """Returns annotation of numeric df's (or CompactMatrix's) "m/z_RT" features, indexed by
+    feature, with columns "m/z", "RT", "group" and "representative"."""
+    features = df.features if isinstance(df, cp.CompactMatrix) else df.columns
+    mz, rt = parse_mz_rt_labels(list(features))
+    groups = group_isotopes_and_adducts(mz, rt, ppm, rt_window, mass_differences)
+    intensity = get_mean_intensity(df)
+    return pd.DataFrame(
+        {
+            "m/z": mz,
+            "RT": rt,
+            "group": groups,
+            "representative": get_representative_features(groups, intensity, mz),
+        },
+        index=features,
+    )
+
+
+def collapse_isotope_and_adduct_features(df, ppm=10, rt_window=0.05, mass_differences=None):
+    """Keeps only the representative feature column of every isotope / adduct group in
+    numeric df (or CompactMatrix) with "m/z_RT" feature columns."""
+    annotation = annotate_mz_rt_features(df, ppm, rt_window, mass_differences)
+    is_representative = annotation["representative"].to_numpy()
+    if isinstance(df, cp.CompactMatrix):
+        return cp.select_compact(df, cols=is_representative)
+    return df.loc[:, is_representative]
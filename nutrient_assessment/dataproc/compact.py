@@ -0,0 +1,326 @@
+"""
+montenegro-burke-ms/nutrient_assessment/dataproc/compact.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Opt-in compact storage for intensity matrices (rows are samples, columns
+are features). Intensities are held as float32 with an explicit missing-value
+mask instead of float64 with NaN. Tables where most cells are missing (e.g.
+0.0 readings in the timsTOF bucket table) are held as a scipy CSR matrix,
+where the stored entries are the valid cells.
+
+The rectified pipelines opt in with `compact=True`: the export is converted
+once at read time and stays a `CompactMatrix` through normalization,
+aggregation and log2 fold changes. The DataFrame functions in
+`dataproc.untargeted_ms` accept a `CompactMatrix` and dispatch to this module.
+
+Dense matrices are aggregated in float32 buffers and sparse matrices in
+float64 over the valid cells only. Counts are exact. Means and fold changes
+agree with the float64 functions in `dataproc.matrix` within `RTOL`
+(relative), so log2 fold changes agree within `LOG2_ATOL` (absolute).
+Standard deviations agree within `RTOL` times the group mean, as float32
+rounding of the inputs dominates when the CV is small.
+
+scipy is only imported when sparse storage is used.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import dataproc.matrix as mx
+
+# Fraction of valid cells below which `to_compact` picks the sparse representation
+SPARSE_DENSITY_THRESHOLD = 0.3
+# Tolerance of compact results against float64 results - see module docstring
+RTOL = 1e-5
+# log2 of a relative error of RTOL
+LOG2_ATOL = RTOL / np.log(2)
+
+# `values` is a float32 ndarray (missing cells hold 0) or a float32 CSR matrix (missing
+# cells are not stored). `is_valid` is a bool ndarray, or None for CSR matrices.
+CompactMatrix = namedtuple("CompactMatrix", ["values", "is_valid", "features", "samples"])
+
+
+def to_compact(values, features, samples, missing_value=np.nan, sparse_storage=None):
+    """Returns CompactMatrix of float `values`, treating NaN and `missing_value` as missing.
+    Uses sparse storage if `sparse_storage` is True, or if it is None and the fraction of
+    valid cells is below SPARSE_DENSITY_THRESHOLD."""
+    is_valid = ~np.isnan(values)
+    if not np.isnan(missing_value):
+        is_valid &= values != missing_value
+    if sparse_storage is None:
+        sparse_storage = is_valid.mean() < SPARSE_DENSITY_THRESHOLD if is_valid.size else False
+    if sparse_storage:
+        rows, cols = np.nonzero(is_valid)
+        # Valid zeros are kept as explicit entries - the CSR structure is the mask
+        values_csr = _get_csr(values[rows, cols].astype(np.float32), rows, cols, values.shape)
+        return CompactMatrix(values_csr, None, features, samples)
+    return CompactMatrix(
+        np.where(is_valid, values, 0).astype(np.float32), is_valid, features, samples
+    )
+
+
+def df_to_compact(df, missing_value=np.nan, sparse_storage=None):
+    """Returns CompactMatrix of numeric df."""
+    values, features, samples = mx.df_to_values(df)
+    return to_compact(values, features, samples, missing_value, sparse_storage)
+
+
+def is_sparse(compact):
+    return not isinstance(compact.values, np.ndarray)
+
+
+def _get_csr(data, rows, cols, shape):
+    # Imported here - scipy is only needed for sparse storage
+    from scipy import sparse
+
+    return sparse.csr_matrix((data, (rows, cols)), shape=shape)
+
+
+def _get_csr_rows(values_csr):
+    """Returns row index of every stored entry of `values_csr`."""
+    return np.repeat(np.arange(values_csr.shape[0]), np.diff(values_csr.indptr))
+
+
+def _get_csr_structure(values_csr):
+    structure = values_csr.copy()
+    structure.data = np.ones_like(structure.data)
+    return structure
+
+
+def get_valid_indicator(compact):
+    """Returns the missing-value mask as 1.0 (valid) / 0.0 (missing), in the storage
+    format of compact."""
+    if is_sparse(compact):
+        return _get_csr_structure(compact.values)
+    return compact.is_valid.astype(np.float32)
+
+
+def get_valid_counts(compact, axis=0):
+    """Returns number of valid cells of every feature (axis=0) or sample (axis=1)."""
+    if is_sparse(compact):
+        if axis == 0:
+            return np.bincount(compact.values.indices, minlength=compact.values.shape[1])
+        return np.diff(compact.values.indptr)
+    return compact.is_valid.sum(axis=axis)
+
+
+def compact_to_values(compact):
+    """Returns float64 (values, features, samples) with missing cells as NaN."""
+    if is_sparse(compact):
+        values = np.full(compact.values.shape, np.nan)
+        values_coo = compact.values.tocoo()
+        values[values_coo.row, values_coo.col] = values_coo.data
+    else:
+        values = compact.values.astype(np.float64)
+        values[~compact.is_valid] = np.nan
+    return values, compact.features, compact.samples
+
+
+def compact_to_df(compact):
+    return mx.values_to_df(*compact_to_values(compact))
+
+
+def select_compact(compact, rows=None, cols=None):
+    """Returns compact with only samples `rows` and features `cols` (positions or bool
+    masks). None keeps every sample / feature."""
+    n_samples, n_features = compact.values.shape
+    rows = np.arange(n_samples) if rows is None else _get_positions(rows)
+    cols = np.arange(n_features) if cols is None else _get_positions(cols)
+    if is_sparse(compact):
+        values, is_valid = compact.values[rows][:, cols], None
+    else:
+        values, is_valid = compact.values[np.ix_(rows, cols)], compact.is_valid[np.ix_(rows, cols)]
+    return CompactMatrix(values, is_valid, compact.features[cols], compact.samples[rows])
+
+
+def _get_positions(idx):
+    idx = np.asarray(idx)
+    return np.flatnonzero(idx) if idx.dtype == bool else idx
+
+
+def drop_compact_samples(compact, labels):
+    """Drops samples labeled any of `labels`. Raises KeyError if any label is not found,
+    as `DataFrame.drop`."""
+    labels_not_found = [label for label in labels if label not in compact.samples]
+    if labels_not_found:
+        raise KeyError(f"{labels_not_found} not found in samples")
+    return select_compact(compact, rows=~compact.samples.isin(labels))
+
+
+def dropna_compact(compact):
+    """Keeps features without missing cells, as `DataFrame.dropna(axis=1)`."""
+    return select_compact(compact, cols=get_valid_counts(compact) == compact.values.shape[0])
+
+
+def _map_valid(compact, func):
+    """Applies `func` to valid cells. Cells where `func` returns NaN become missing."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if is_sparse(compact):
+            values_csr = compact.values
+            data = func(values_csr.data).astype(np.float32)
+            is_valid = ~np.isnan(data)
+            values_csr = _get_csr(
+                data[is_valid],
+                _get_csr_rows(values_csr)[is_valid],
+                values_csr.indices[is_valid],
+                values_csr.shape,
+            )
+            return CompactMatrix(values_csr, None, compact.features, compact.samples)
+        values = func(compact.values).astype(np.float32, copy=False)
+    is_valid = compact.is_valid & ~np.isnan(values)
+    values[~is_valid] = 0
+    return CompactMatrix(values, is_valid, compact.features, compact.samples)
+
+
+def _any_valid(compact, func):
+    """Returns, for every feature, whether `func` is True for any valid cell."""
+    if is_sparse(compact):
+        is_true = func(compact.values.data)
+        counts = np.bincount(compact.values.indices[is_true], minlength=compact.values.shape[1])
+        return counts > 0
+    return (func(compact.values) & compact.is_valid).any(axis=0)
+
+
+def _all_valid(compact, func):
+    """Returns, for every feature, whether every cell is valid and `func` is True for it."""
+    if is_sparse(compact):
+        is_true = func(compact.values.data)
+        counts = np.bincount(compact.values.indices[is_true], minlength=compact.values.shape[1])
+        return counts == compact.values.shape[0]
+    return (func(compact.values) & compact.is_valid).all(axis=0)
+
+
+def divide_compact(numerator, denominator):
+    """Divides dense compact matrices of the same shape cell by cell (e.g. std by mean for
+    CV). Cells are missing if either operand is missing."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = np.divide(numerator.values, denominator.values, dtype=np.float32)
+    is_valid = numerator.is_valid & denominator.is_valid & ~np.isnan(values)
+    values[~is_valid] = 0
+    return CompactMatrix(values, is_valid, numerator.features, numerator.samples)
+
+
+def normalize_compact_to_ref_row_in_chunks(compact, chunk_size, ref_row_idx):
+    """Divides every chunk of `chunk_size` rows by the chunk's row at `ref_row_idx`.
+    Cells are missing after division if they or their reference cell were missing."""
+    n_samples = compact.values.shape[0]
+    ref_rows = np.arange(ref_row_idx, n_samples, chunk_size)
+    if len(ref_rows) != len(range(0, n_samples, chunk_size)):
+        raise IndexError(f"Last chunk has no row at ref_row_idx {ref_row_idx}")
+    ref_values, _, _ = compact_to_values(select_compact(compact, rows=ref_rows))
+    if is_sparse(compact):
+        values_csr = compact.values
+        rows = _get_csr_rows(values_csr)
+        ref_entries = ref_values[rows // chunk_size, values_csr.indices]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            data = (values_csr.data / ref_entries).astype(np.float32)
+        # NaN where the reference is missing, or 0 / 0
+        is_valid = ~np.isnan(data)
+        values_csr = _get_csr(
+            data[is_valid], rows[is_valid], values_csr.indices[is_valid], values_csr.shape
+        )
+        return CompactMatrix(values_csr, None, compact.features, compact.samples)
+
+    ref_values = np.repeat(ref_values, chunk_size, axis=0)[:n_samples]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = np.divide(compact.values, ref_values, dtype=np.float32)
+    is_valid = compact.is_valid & ~np.isnan(values)
+    values[~is_valid] = 0
+    return CompactMatrix(values, is_valid, compact.features, compact.samples)
+
+
+def log2_compact(compact):
+    """Returns log2 of compact. Valid zeros become -inf, as in float64."""
+    return _map_valid(compact, np.log2)
+
+
+def get_log2_compact_directional(compact, downregulated=False, log2_weight=1):
+    """As `dataproc.matrix.get_log2_values_directional` - keeps features with any finite
+    log2 value greater than log2_weight (less than -log2_weight if downregulated=True)."""
+    compact_log = log2_compact(compact)
+    if downregulated:
+        keep = _any_valid(compact_log, lambda values: np.isfinite(values) & (values < -log2_weight))
+    else:
+        keep = _any_valid(compact_log, lambda values: np.isfinite(values) & (values > log2_weight))
+    return select_compact(compact_log, cols=keep)
+
+
+def get_log2_compact(compact, log2_weight=1):
+    """As `dataproc.matrix.get_log2_values` - keeps features with any finite log2 value
+    greater than log2_weight or less than -log2_weight."""
+    compact_log = log2_compact(compact)
+    keep = _any_valid(
+        compact_log, lambda values: np.isfinite(values) & (np.abs(values) > log2_weight)
+    )
+    return select_compact(compact_log, cols=keep)
+
+
+def get_compact_values_within_range(compact, min, max):
+    """As `dataproc.matrix.get_values_within_range` - keeps features where every value is
+    valid and within (min, max)."""
+    return select_compact(
+        compact, cols=_all_valid(compact, lambda values: (values > min) & (values < max))
+    )
+
+
+def group_and_agg_compact(compact, groups, agg_type, ddof=1):
+    """Aggregates rows of compact sharing the same label in `groups`, ignoring missing cells.
+    `agg_type` is one of "mean", "std" or "count". Returns a dense CompactMatrix with one
+    sample per group, sorted as in `DataFrame.groupby`. Aggregates that are NaN in
+    `dataproc.matrix.group_and_agg_values` (e.g. no valid cells) are missing."""
+    agg_values, group_labels = _group_and_agg_values(compact, groups, agg_type, ddof)
+    samples = pd.Index(group_labels, name=getattr(groups, "name", None))
+    return to_compact(
+        np.asarray(agg_values, dtype=np.float64), compact.features, samples, sparse_storage=False
+    )
+
+
+def _group_and_agg_values(compact, groups, agg_type, ddof):
+    codes, group_labels = mx.factorize_groups(groups)
+    if is_sparse(compact):
+        agg_values = _group_and_agg_sparse(compact.values, codes, len(group_labels), agg_type, ddof)
+        return agg_values, group_labels
+    # float32 indicator - a float64 operand would upcast (copy) the whole matrix
+    indicator = mx.get_group_indicator(codes, len(group_labels), dtype=np.float32)
+    counts = (indicator @ compact.is_valid.astype(np.float32)).astype(np.float64)
+    if agg_type == "count":
+        return counts.astype(np.int64), group_labels
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = (indicator @ compact.values) / counts
+        if agg_type == "mean":
+            return means, group_labels
+        if agg_type == "std":
+            # Two-pass variance in a single float32 buffer
+            values_dev = np.subtract(compact.values, means[codes], dtype=np.float32)
+            values_dev[~compact.is_valid | (codes < 0)[:, np.newaxis]] = 0
+            np.square(values_dev, out=values_dev)
+            return _get_std(indicator @ values_dev, counts, ddof), group_labels
+    raise ValueError(f"agg_type requires one of 'mean', 'std', or 'count'. Found {agg_type}")
+
+
+def _group_and_agg_sparse(values_csr, codes, n_groups, agg_type, ddof):
+    # Dense (groups, samples) indicator @ CSR returns a dense (groups, features) array
+    indicator = mx.get_group_indicator(codes, n_groups)
+    # Valid cells only, in float64 - this is proportional to the number of valid cells
+    values_csr = values_csr.astype(np.float64)
+    counts = np.asarray(indicator @ _get_csr_structure(values_csr))
+    if agg_type == "count":
+        return counts.astype(np.int64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.asarray(indicator @ values_csr) / counts
+        if agg_type == "mean":
+            return means
+        if agg_type == "std":
+            sums_sq = np.asarray(indicator @ values_csr.multiply(values_csr))
+            return _get_std(sums_sq - counts * means ** 2, counts, ddof)
+    raise ValueError(f"agg_type requires one of 'mean', 'std', or 'count'. Found {agg_type}")
+
+
+def _get_std(sums_sq_dev, counts, ddof):
+    variances = np.clip(np.asarray(sums_sq_dev, dtype=np.float64), 0, None) / (counts - ddof)
+    variances[counts - ddof <= 0] = np.nan
+    return np.sqrt(variances)
@@ -0,0 +1,124 @@
+"""
+montenegro-burke-ms/nutrient_assessment/dataproc/matrix.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+NumPy core of `dataproc.untargeted_ms`. Every function here works on a
+float matrix (`values`, rows are samples and columns are features)
+plus separate `features` and `samples` index arrays, and writes in place or
+to `out=` wherever the caller does not need the input afterwards.
+
+The DataFrame functions in `dataproc.untargeted_ms` are thin wrappers that
+convert with `df_to_values` / `values_to_df` and call into this module.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def df_to_values(df, copy=False):
+    """Returns (values, features, samples) of numeric df. `values` is a float64 matrix in
+    the memory order of df's block, copied from df only when required or when `copy` is True."""
+    values = df.to_numpy(dtype=np.float64)
+    if copy:
+        return values.copy(order="K"), df.columns, df.index
+    return values, df.columns, df.index
+
+
+def values_to_df(values, features, samples):
+    """Wraps `values` as a DataFrame without copying."""
+    return pd.DataFrame(values, index=samples, columns=features, copy=False)
+
+
+def is_numeric_df(df):
+    return all(pd.api.types.is_numeric_dtype(dtype) for dtype in df.dtypes)
+
+
+def transpose_values(values, features, samples):
+    """Swaps samples and features. Returns a view of `values`."""
+    return values.T, samples, features
+
+
+def convert_value_to_nan(values, value):
+    """Replaces `value` (scalar or list of scalars) with NaN in place."""
+    values[np.isin(values, value)] = np.nan
+    return values
+
+
+def get_values_within_range(values, features, min, max):
+    """Keeps feature columns where every value is non-NaN and within (min, max)."""
+    keep = ((values > min) & (values < max)).all(axis=0)
+    return values[:, keep], features[keep]
+
+
+def get_log2_values_directional(values, features, downregulated=False, log2_weight=1, out=None):
+    """Keeps feature columns with any finite log2 value greater than log2_weight if
+    downregulated=False. Less than -log2_weight will be kept if downregulated=True."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values_log = np.log2(values, out=out)
+    if downregulated:
+        mask = values_log < -log2_weight
+    else:
+        mask = values_log > log2_weight
+    keep = (mask & np.isfinite(values_log)).any(axis=0)
+    return values_log[:, keep], features[keep]
+
+
+def get_log2_values(values, features, log2_weight=1, out=None):
+    """Keeps feature columns with any finite log2 value greater than log2_weight or
+    less than -log2_weight."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values_log = np.log2(values, out=out)
+    mask = np.abs(values_log) > log2_weight
+    keep = (mask & np.isfinite(values_log)).any(axis=0)
+    return values_log[:, keep], features[keep]
+
+
+def normalize_values_to_ref_row_in_chunks(values, chunk_size, ref_row_idx, out=None):
+    """Divides every chunk of `chunk_size` rows by the chunk's row at `ref_row_idx`
+    (e.g. the control within a biological replicate)."""
+    if out is None:
+        out = values
+    for i in range(0, values.shape[0], chunk_size):
+        # Copy reference row - it is overwritten by the division when out is values
+        ref_row = values[i + ref_row_idx].copy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.divide(values[i : i + chunk_size], ref_row, out=out[i : i + chunk_size])
+    return out
+
+
+def factorize_groups(groups):
+    """Returns (codes, group_labels) of `groups`, with labels sorted as in `DataFrame.groupby`.
+    NaN group labels are coded -1."""
+    return pd.factorize(np.asarray(groups), sort=True)
+
+
+def get_group_indicator(codes, n_groups, dtype=np.float64):
+    """Returns (n_groups, n_samples) indicator matrix of `codes`. Code -1 matches no group."""
+    return (codes == np.arange(n_groups)[:, np.newaxis]).astype(dtype)
+
+
+def group_and_agg_values(values, groups, agg_type, ddof=1):
+    """Aggregates rows of `values` sharing the same label in `groups`, ignoring NaN.
+    `agg_type` is one of "mean", "std" or "count". Returns (agg_values, group_labels),
+    with group labels sorted as in `DataFrame.groupby`."""
+    codes, group_labels = factorize_groups(groups)
+    indicator = get_group_indicator(codes, len(group_labels), dtype=values.dtype)
+    is_valid = ~np.isnan(values)
+    counts = indicator @ is_valid.astype(values.dtype)
+    if agg_type == "count":
+        return counts.astype(np.int64), group_labels
+
+    values_filled = np.where(is_valid, values, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = (indicator @ values_filled) / counts
+        if agg_type == "mean":
+            return means, group_labels
+        if agg_type == "std":
+            # Two-pass variance - subtract group mean from each row, reusing values_filled
+            np.subtract(values_filled, means[codes], out=values_filled)
+            values_filled[~is_valid | (codes < 0)[:, np.newaxis]] = 0
+            np.square(values_filled, out=values_filled)
+            variances = (indicator @ values_filled) / (counts - ddof)
+            variances[counts - ddof <= 0] = np.nan
+            return np.sqrt(variances), group_labels
+    raise ValueError(f"agg_type requires one of 'mean', 'std', or 'count'. Found {agg_type}")
@@ -0,0 +1,124 @@
+"""
+montenegro-burke-ms/nutrient_assessment/dataproc/reconcile.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Reconciles per-feature log2 fold changes of the same nutrient array run on
+two platforms, e.g. qTOF features keyed by compound name and timsTOF
+features keyed by "m/z_RT" labels.
+
+Features are joined on mass within `ppm` (and optionally RT within
+`rt_window`) with a sorted-window join: one side is sorted by mass once, and
+every mass on the other side finds its window with two binary searches. Cost
+is O((n + m) log m + matches) instead of the O(n * m) cross product.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def parse_mz_rt_labels(labels):
+    """Returns float arrays (m/z, RT) parsed from "m/z_RT" feature labels."""
+    mz_rt = pd.Series(labels, dtype=str).str.split("_", n=1, expand=True).astype(float)
+    return mz_rt[0].to_numpy(), mz_rt[1].to_numpy()
+
+
+def join_within_ppm(left_mass, right_mass, ppm, left_rt=None, right_rt=None, rt_window=None):
+    """Returns index arrays (left_idx, right_idx) of every pair where right_mass is within
+    `ppm` of left_mass and, if `rt_window` is given, RTs differ by at most `rt_window`."""
+    left_mass = np.asarray(left_mass, dtype=np.float64)
+    right_mass = np.asarray(right_mass, dtype=np.float64)
+    right_order = np.argsort(right_mass, kind="stable")
+    right_mass_sorted = right_mass[right_order]
+
+    # [lo, hi) window of sorted right masses for every left mass
+    tolerance = np.abs(left_mass) * ppm * 1e-6
+    lo = np.searchsorted(right_mass_sorted, left_mass - tolerance, side="left")
+    hi = np.searchsorted(right_mass_sorted, left_mass + tolerance, side="right")
+    counts = hi - lo
+
+    # Expand windows into pairs without a Python loop
+    left_idx = np.repeat(np.arange(len(left_mass)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    right_idx = right_order[np.repeat(lo, counts) + offsets]
+
+    if rt_window is not None:
+        rt_diff = np.asarray(left_rt, dtype=np.float64)[left_idx] - np.asarray(right_rt)[right_idx]
+        is_within_rt = np.abs(rt_diff) <= rt_window
+        left_idx, right_idx = left_idx[is_within_rt], right_idx[is_within_rt]
+    return left_idx, right_idx
+
+
+def reconcile_log2_fold_changes(
+    left_log2, left_features, right_log2, right_features, ppm=10, rt_window=None, log2_weight=1
+):
+    """Joins per-feature log2 fold changes of two platforms and classifies every matched
+    feature pair in every shared nutrient condition.
+
+    `left_log2` / `right_log2` are DataFrames of log2 fold changes (rows are nutrient
+    conditions, columns are features). `left_features` / `right_features` are DataFrames
+    indexed by the same feature names with columns "Mass" (neutral mass) and "RT".
+
+    A pair is a hit if either platform's |log2| is at least log2_weight. A hit passing on
+    both platforms is concordant if the signs agree and discordant if they differ; a hit
+    passing on only one platform is a single platform hit.
+    Returns (pairs, summary): pairs has one row per matched pair and condition, summary
+    counts matched pairs, hits, concordant, discordant and single platform hits per
+    condition."""
+    left_features = left_features.reindex(list(left_log2)).dropna(subset=["Mass"])
+    right_features = right_features.reindex(list(right_log2)).dropna(subset=["Mass"])
+    left_idx, right_idx = join_within_ppm(
+        left_features["Mass"].to_numpy(),
+        right_features["Mass"].to_numpy(),
+        ppm,
+        left_rt=left_features["RT"].to_numpy(),
+        right_rt=right_features["RT"].to_numpy(),
+        rt_window=rt_window,
+    )
+    left_names = left_features.index[left_idx]
+    right_names = right_features.index[right_idx]
+    left_mass = left_features["Mass"].to_numpy()[left_idx]
+    right_mass = right_features["Mass"].to_numpy()[right_idx]
+    rt_diff = right_features["RT"].to_numpy()[right_idx] - left_features["RT"].to_numpy()[left_idx]
+
+    conditions = left_log2.index.intersection(right_log2.index)
+    # (conditions, pairs) matrices of fold changes, gathered once per side
+    left_values = left_log2.loc[conditions, left_names].to_numpy(dtype=np.float64)
+    right_values = right_log2.loc[conditions, right_names].to_numpy(dtype=np.float64)
+
+    with np.errstate(invalid="ignore"):
+        is_left_hit = np.abs(left_values) >= log2_weight
+        is_right_hit = np.abs(right_values) >= log2_weight
+        is_same_sign = np.sign(left_values) == np.sign(right_values)
+    is_hit = is_left_hit | is_right_hit
+    is_both_hit = is_left_hit & is_right_hit
+    is_concordant = is_both_hit & is_same_sign
+    is_discordant = is_both_hit & ~is_same_sign
+    is_single_platform = is_left_hit ^ is_right_hit
+
+    n_pairs = len(left_idx)
+    pairs = pd.DataFrame(
+        {
+            "Sample Group": np.repeat(conditions, n_pairs),
+            "left_feature": np.tile(left_names, len(conditions)),
+            "right_feature": np.tile(right_names, len(conditions)),
+            "ppm_error": np.tile((right_mass - left_mass) / left_mass * 1e6, len(conditions)),
+            "rt_diff": np.tile(rt_diff, len(conditions)),
+            "left_log2": left_values.ravel(),
+            "right_log2": right_values.ravel(),
+            "hit": is_hit.ravel(),
+            "concordant": is_concordant.ravel(),
+            "discordant": is_discordant.ravel(),
+            "single_platform": is_single_platform.ravel(),
+        }
+    )
+    summary = pd.DataFrame(
+        {
+            "matched": np.full(len(conditions), n_pairs),
+            "hits": is_hit.sum(axis=1),
+            "concordant": is_concordant.sum(axis=1),
+            "discordant": is_discordant.sum(axis=1),
+            "single_platform": is_single_platform.sum(axis=1),
+        },
+        index=pd.Index(conditions, name="Sample Group"),
+    )
+    return pairs, summary
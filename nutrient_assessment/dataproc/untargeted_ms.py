@@ -1,10 +1,15 @@
 import numpy as np
 import pandas as pd
 
+import dataproc.compact as cp
+import dataproc.matrix as mx
+
 
 def get_df_values_within_range(df, min, max):
-    df = df[df.fillna(0) < max]
-    return df[df.fillna(0) > min].dropna(axis=1)
+    if isinstance(df, cp.CompactMatrix):
+        return cp.get_compact_values_within_range(df, min, max)
+    values, features, samples = mx.df_to_values(df)
+    return mx.values_to_df(*mx.get_values_within_range(values, features, min, max), samples)
 
 
 def get_empty_df_from_df(df):
@@ -15,17 +20,25 @@ def concat_df(*args, axis=0):
     return pd.concat(list(args), axis=axis)
 
 
+def get_cols_to_keep(colnames, col_substrings):
+    """Returns colnames containing any of `col_substrings`, ordered by `col_substrings`."""
+    cols_to_keep = []
+    for col_substring in col_substrings:
+        cols_to_keep.extend([colname for colname in colnames if col_substring in colname])
+    return cols_to_keep
+
+
 def get_df_with_cols_to_keep(df, col_substrings=None):
     if not col_substrings:
         return df
-    cols_to_keep = []
-    for col_substring in col_substrings:
-        cols_to_keep.extend([colname for colname in list(df) if col_substring in colname])
-    return df[cols_to_keep]
+    return df[get_cols_to_keep(list(df), col_substrings)]
 
 
 def convert_value_to_nan(df, value):
-    return df.replace(value, np.nan, inplace=False)
+    if not mx.is_numeric_df(df):
+        return df.replace(value, np.nan, inplace=False)
+    values, features, samples = mx.df_to_values(df, copy=True)
+    return mx.values_to_df(mx.convert_value_to_nan(values, value), features, samples)
 
 
 def drop_rows_with_substring_in_col_value(df, colname, substring):
@@ -64,48 +77,69 @@ def map_ternary_exp_and_replace_values(df, ternary_cond, new_colname):
 
 
 def group_and_agg(df, colname, agg_type):
+    """Aggregates df grouped by `colname`. A CompactMatrix is grouped by its samples, which
+    must be labeled `colname`, and stays compact - see `dataproc.compact`."""
+    if isinstance(df, cp.CompactMatrix):
+        return cp.group_and_agg_compact(df, df.samples.get_level_values(colname), agg_type)
     agg_type_map = {
         "mean": np.nanmean,
         "std": np.nanstd,
     }
     if isinstance(agg_type, list):
         return df.groupby([colname]).agg(agg_type)
-    return df.groupby([colname]).agg(agg_type_map.get(agg_type, agg_type))
+    # Group by column, or by index level if colname was set as index
+    if colname in df.columns:
+        groups, df_values = df[colname], df.drop(columns=colname)
+    else:
+        groups, df_values = df.index.get_level_values(colname), df
+    if agg_type not in ("mean", "std", "count") or not mx.is_numeric_df(df_values):
+        return df.groupby([colname]).agg(agg_type_map.get(agg_type, agg_type))
+    values, features, _ = mx.df_to_values(df_values)
+    agg_values, group_labels = mx.group_and_agg_values(values, groups, agg_type)
+    return mx.values_to_df(agg_values, features, pd.Index(group_labels, name=colname))
 
 
 def get_log2_df_directional(df, downregulated=False, log2_weight=1):
     """Get df where any column values greater than log2_weight will be kept
     if downregulated=False. Less than log2_weight will be kept if downregulated=True."""
-    # Convert values to log2 - get a sense of upregulation and downregulation
-    df_log = np.log2(df)
-    # Remove inf / -inf and replace NaN with 0
-    df_log = convert_value_to_nan(df_log, [np.inf, -np.inf])
-
-    # Refine values to query - improves resolution of large differences
-    if downregulated:
-        df_log = df_log[df_log.fillna(0) < -log2_weight]
-    else:
-        df_log = df_log[df_log.fillna(0) > log2_weight]
-
-    df_log = df_log.dropna(axis=1, how="all")
-    header_colnames_to_keep = list(df_log)
-    return np.log2(df[header_colnames_to_keep])
+    if isinstance(df, cp.CompactMatrix):
+        return cp.get_log2_compact_directional(df, downregulated, log2_weight)
+    values, features, samples = mx.df_to_values(df)
+    # log2 is written to a single new buffer - inf / -inf never pass the log2_weight filter
+    values_log, features = mx.get_log2_values_directional(
+        values, features, downregulated=downregulated, log2_weight=log2_weight
+    )
+    return mx.values_to_df(values_log, features, samples)
 
 
 def get_log2_df(df, log2_weight=1):
     """Get df where any column values greater than log2_weight or less than
     log2_weight will be kept."""
-    # Convert values to log2 - get a sense of upregulation and downregulation
-    df_log = np.log2(df)
-    # Remove inf / -inf and replace NaN with 0
-    df_log = convert_value_to_nan(df_log, [np.inf, -np.inf])
-
-    # Refine values to query - improves resolution of large differences
-    df_log_downregulated = df_log[df_log.fillna(0) < -log2_weight]
-    df_log_upregulated = df_log[df_log.fillna(0) > log2_weight]
-    df_log_downregulated[df_log_downregulated.isnull()] = df_log_upregulated
-    df_log = df_log_downregulated
-
-    df_log = df_log.dropna(axis=1, how="all")
-    header_colnames_to_keep = list(df_log)
-    return np.log2(df[header_colnames_to_keep])
+    if isinstance(df, cp.CompactMatrix):
+        return cp.get_log2_compact(df, log2_weight)
+    values, features, samples = mx.df_to_values(df)
+    values_log, features = mx.get_log2_values(values, features, log2_weight=log2_weight)
+    return mx.values_to_df(values_log, features, samples)
+
+
+def normalize_df_to_ref_row_in_chunks(df, chunk_size, ref_row_idx):
+    """Divides every chunk of `chunk_size` rows by the chunk's row at `ref_row_idx`.
+    Replaces chunk-wise `concat_df` - writes into a single copy of df."""
+    if isinstance(df, cp.CompactMatrix):
+        return cp.normalize_compact_to_ref_row_in_chunks(df, chunk_size, ref_row_idx)
+    values, features, samples = mx.df_to_values(df, copy=True)
+    values = mx.normalize_values_to_ref_row_in_chunks(values, chunk_size, ref_row_idx)
+    return mx.values_to_df(values, features, samples)
+
+
+def drop_cols_with_nan(df):
+    if isinstance(df, cp.CompactMatrix):
+        return cp.dropna_compact(df)
+    return df.dropna(axis=1)
+
+
+def to_df(df):
+    """Returns df, or a CompactMatrix converted back to a float64 DataFrame."""
+    if isinstance(df, cp.CompactMatrix):
+        return cp.compact_to_df(df)
+    return df
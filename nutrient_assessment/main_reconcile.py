@@ -0,0 +1,73 @@
+"""
+montenegro-burke-ms/nutrient_assessment/main_reconcile.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Compares log2 fold changes of the nutrient array run on the Agilent qTOF
+(`main_untargeted_rectified`, features keyed by compound name) and on the
+timsTOF (`main_timsTOF_rectified`, features keyed by "m/z_RT").
+
+qTOF compounds are matched to timsTOF features on neutral mass within `ppm`,
+taking timsTOF neutral masses from the export's "Bucket label". Matched pairs are classified as
+concordant, discordant or single platform hits in every nutrient condition - see
+`dataproc.reconcile.reconcile_log2_fold_changes`.
+
+Output data can be found here:
+montenegro-burke-ms/nutrient_assessment/data/reconciled_qTOF_timsTOF.csv
+"""
+
+import os
+
+import dataproc.reconcile as rc
+import main_timsTOF_rectified as mt
+import main_untargeted_rectified as mu
+
+BASE_PATH = os.path.abspath(os.path.dirname(__file__))
+DATA_PATH = os.path.join(BASE_PATH, "data")
+
+
+def reconcile_qtof_and_timstof(
+    qtof_path,
+    tims_path,
+    ppm=20,
+    rt_window=None,
+    log2_weight=1,
+    cache=None,
+):
+    """Returns (pairs, summary) of qTOF export at `qtof_path` reconciled with timsTOF export
+    at `tims_path`. `rt_window` (min) is off by default, as the two LC methods differ."""
+    qtof_log2 = mu.get_norm_agg_nutrient_mean_log2_all(qtof_path, cache=cache)
+    qtof_features = mu.read_compound_mass_and_rt(qtof_path)
+
+    tims_log2 = mt.get_norm_agg_nutrient_mean_log2_all(tims_path, cache=cache)
+    tims_features = mt.read_bucket_mass_and_rt(tims_path)
+
+    pairs, summary = rc.reconcile_log2_fold_changes(
+        qtof_log2,
+        qtof_features,
+        tims_log2,
+        tims_features,
+        ppm=ppm,
+        rt_window=rt_window,
+        log2_weight=log2_weight,
+    )
+    pairs = pairs.rename(
+        columns={
+            "left_feature": "qTOF compound",
+            "right_feature": "timsTOF feature",
+            "left_log2": "qTOF log2",
+            "right_log2": "timsTOF log2",
+        }
+    )
+    return pairs, summary
+
+
+if __name__ == "__main__":
+    qtof_path = os.path.join(
+        DATA_PATH, "exportFile_irahorecka_yeast_nutrient_array_350milliminute_retention_time.csv"
+    )
+    tims_path = os.path.join(DATA_PATH, "20211104_IH_timsTOF_Experiment.csv")
+    pairs, summary = reconcile_qtof_and_timstof(qtof_path, tims_path)
+    print(summary)
+
+    # Export data as CSV for further analysis
+    pairs.to_csv(os.path.join(DATA_PATH, "reconciled_qTOF_timsTOF.csv"), index=False)
@@ -1,20 +1,45 @@
 import os
 
 from dataproc import read_csv
+import dataproc.compact as cp
 import dataproc.untargeted_ms as ms
 import main_untargeted_rectified as mu
+import result_cache
 
 BASE_PATH = os.path.abspath(os.path.dirname(__file__))
 DATA_PATH = os.path.join(BASE_PATH, "data")
 FIGURES_PATH = os.path.join(BASE_PATH, "figures")
 
 
-if __name__ == "__main__":
-    # Get pandas df from CSV path
-    small_molecule_path = os.path.join(
-        DATA_PATH,
-        "exportFile_irahorecka_yeast_nutrient_array_batch_recursive_small_molecule_350milliminute_retention_time.csv",
-    )
+def collapse_isotope_features(df, ppm=10, rt_window=0.05):
+    """Keeps one representative feature per 13C isotope group (see `dataproc.annotate`) of
+    df with a "Sample Group" column, or of a CompactMatrix. DetectedMass features are
+    labeled "Mass_RT" with Profinder neutral Mass, so adduct mass differences are not applied."""
+    # Imported here - scipy is only needed for isotope grouping
+    import dataproc.annotate as an
+
+    if isinstance(df, cp.CompactMatrix):
+        return an.collapse_isotope_and_adduct_features(
+            df, ppm=ppm, rt_window=rt_window, mass_differences=an.ISOTOPE_MASS_DIFFERENCES
+        )
+    df = ms.convert_to_numerics(df).set_index("Sample Group")
+    return an.collapse_isotope_and_adduct_features(
+        df, ppm=ppm, rt_window=rt_window, mass_differences=an.ISOTOPE_MASS_DIFFERENCES
+    ).reset_index()
+
+
+def read_and_normalize_nutrient_data(
+    small_molecule_path,
+    chunk_size=6,
+    collapse_isotopes=False,
+    isotope_ppm=10,
+    isotope_rt_window=0.05,
+    compact=False,
+):
+    """Reads batch recursive export at `small_molecule_path` and normalizes metabolite levels
+    within each biological replicate of `chunk_size` samples. If `collapse_isotopes`, keeps
+    one representative feature per 13C isotope group (see `collapse_isotope_features`). If
+    `compact`, returns a CompactMatrix (see `dataproc.compact`)."""
     small_molecule_df = read_csv(small_molecule_path).rename(columns={"Mass": "DetectedMass"})
     small_molecule_df["DetectedMass"] = (
         small_molecule_df["DetectedMass"].map(str) + "_" + small_molecule_df["RT"].map(str)
@@ -30,17 +55,77 @@ if __name__ == "__main__":
     small_molecule_df = mu.mutate_and_relabel_nutrient_data(
         small_molecule_df, src_colname="DetectedMass"
     )
-    small_molecule_df = mu.test(small_molecule_df, 6)
-    (
-        agg_nutrient_mean,
-        agg_nutrient_std,
-        agg_nutrient_cv,
-    ) = mu.aggregate_mean_std_cv_from_nutrient_data(small_molecule_df)
+    if compact:
+        # Held as float32 from here on - the float64 df is dropped once converted
+        small_molecule_df = cp.df_to_compact(
+            ms.convert_to_numerics(small_molecule_df).set_index("Sample Group")
+        )
+    if collapse_isotopes:
+        small_molecule_df = collapse_isotope_features(
+            small_molecule_df, ppm=isotope_ppm, rt_window=isotope_rt_window
+        )
+    return mu.normalize_metabolite_levels_within_biological_replicate(small_molecule_df, chunk_size)
+
+
+def get_log2_from_agg_nutrient_data(agg_nutrient_data, log2_weight=1, range_min=-5, range_max=5):
+    """Normalizes aggregated mean data (first of (mean, std, cv) `agg_nutrient_data`) to the
+    control and keeps log2 values greater than log2_weight or less than -log2_weight, within
+    (range_min, range_max)."""
+    agg_nutrient_mean, agg_nutrient_std, agg_nutrient_cv = agg_nutrient_data
 
     # Normalize aggregated mean data to mean of control - perform log2 scaling of results
     norm_agg_nutrient_mean = mu.normalize_nutrient_data_to_control(agg_nutrient_mean)
-    norm_agg_nutrient_mean_log2 = ms.get_log2_df(norm_agg_nutrient_mean, log2_weight=1)
-    norm_agg_nutrient_mean_log2 = ms.get_df_values_within_range(norm_agg_nutrient_mean_log2, -5, 5)
+    norm_agg_nutrient_mean_log2 = ms.get_log2_df(norm_agg_nutrient_mean, log2_weight=log2_weight)
+    norm_agg_nutrient_mean_log2 = ms.get_df_values_within_range(
+        norm_agg_nutrient_mean_log2, range_min, range_max
+    )
+    return ms.to_df(norm_agg_nutrient_mean_log2)
+
+
+def get_norm_agg_nutrient_mean_log2(
+    small_molecule_path,
+    chunk_size=6,
+    log2_weight=1,
+    range_min=-5,
+    range_max=5,
+    cache=None,
+    collapse_isotopes=False,
+    isotope_ppm=10,
+    isotope_rt_window=0.05,
+    compact=False,
+):
+    """Runs the small molecule pipeline on batch recursive export at `small_molecule_path`.
+    Returns log2 transformed nutrient means normalized to the control (GLC | AMN).
+    Stage results are memoized in `cache` (a `result_cache.ResultCache`), if given.
+    If `collapse_isotopes`, isotope features are collapsed before normalization.
+    If `compact`, intensities are held in compact storage (see `dataproc.compact`)."""
+    normalize_params = {"chunk_size": chunk_size}
+    if collapse_isotopes:
+        # Isotope params are unused - and kept out of the cache key - unless collapsing
+        normalize_params.update(
+            collapse_isotopes=True, isotope_ppm=isotope_ppm, isotope_rt_window=isotope_rt_window
+        )
+    if compact:
+        normalize_params["compact"] = True
+    stages = [
+        ("small_molecule_normalize", read_and_normalize_nutrient_data, normalize_params),
+        ("small_molecule_aggregate", mu.aggregate_mean_std_cv_from_nutrient_data, {}),
+        (
+            "small_molecule_log2",
+            get_log2_from_agg_nutrient_data,
+            {"log2_weight": log2_weight, "range_min": range_min, "range_max": range_max},
+        ),
+    ]
+    return result_cache.run_stages(small_molecule_path, stages, cache=cache)
+
+
+if __name__ == "__main__":
+    # Get pandas df from CSV path
+    small_molecule_path = os.path.join(
+        DATA_PATH,
+        "exportFile_irahorecka_yeast_nutrient_array_batch_recursive_small_molecule_350milliminute_retention_time.csv",
+    )
+    norm_agg_nutrient_mean_log2 = get_norm_agg_nutrient_mean_log2(small_molecule_path)
 
     # Export data as CSV for further analysis
     norm_agg_nutrient_mean_log2.to_csv(
@@ -1,36 +1,42 @@
 import os
 
+import numpy as np
+
 from dataproc import read_csv
+import dataproc.compact as cp
 import dataproc.untargeted_ms as ms
+import result_cache
 
 BASE_PATH = os.path.abspath(os.path.dirname(__file__))
 DATA_PATH = os.path.join(BASE_PATH, "data")
 FIGURES_PATH = os.path.join(BASE_PATH, "figures")
 
 
-def normalize_metabolite_levels_within_biological_replicate(df, chunk_size):
-    """Normalizes metabolite levels to the control (GLC | AMN) within each biological replicate."""
+def normalize_metabolite_levels_within_biological_replicate(df, chunk_size, n=2):
+    """Normalizes metabolite levels to the control (GLC | AMN) within each biological replicate.
+    A CompactMatrix (samples labeled by "Sample Group") is normalized in compact storage."""
+    if isinstance(df, cp.CompactMatrix):
+        df = filter_data_with_more_than_n_reads_among_4_samples(df, "Sample Group", n)
+        df = cp.drop_compact_samples(df, ["BLANK", "CTRL"])
+        return ms.normalize_df_to_ref_row_in_chunks(df, chunk_size, ref_row_idx=2)
     df = ms.convert_to_numerics(df)
-    df = filter_data_with_more_than_n_reads_among_4_samples(df, "Sample Group", 2).drop(
+    df = filter_data_with_more_than_n_reads_among_4_samples(df, "Sample Group", n).drop(
         index=["BLANK", "CTRL"]
     )
-    df_concat = ms.get_empty_df_from_df(df)
-    list_df = [df[i : i + chunk_size] for i in range(0, df.shape[0], chunk_size)]
-    for df_ in list_df:
-        df_.loc[:, df_.columns[0] :] = df_.loc[:, df_.columns[0] :].div(
-            df_.iloc[2][df_.columns[0] :]
-        )
-        df_concat = ms.concat_df(df_concat, df_, axis=0)
-    return df_concat.reset_index().rename(columns={"index": "Sample Group"})
+    # Divide each biological replicate (chunk) by its control row in a single copy of df
+    df = ms.normalize_df_to_ref_row_in_chunks(df, chunk_size, ref_row_idx=2)
+    return df.reset_index().rename(columns={"index": "Sample Group"})
 
 
-def aggregate_mean_std_cv_from_nutrient_data(df, agg_colname="Sample Group"):
+def aggregate_mean_std_cv_from_nutrient_data(df, agg_colname="Sample Group", n=2):
     """Aggregates dataframe to find mean, std, and cv, grouping by column
     bound to `agg_colname`. Returns all three aggregated dataframes to caller."""
-    df = filter_data_with_more_than_n_reads_among_4_samples(df, agg_colname, n=2)
+    df = filter_data_with_more_than_n_reads_among_4_samples(df, agg_colname, n=n)
     # Begin aggregation
     df_mean = ms.group_and_agg(df, colname=agg_colname, agg_type="mean")
     df_std = ms.group_and_agg(df, colname=agg_colname, agg_type="std")
+    if isinstance(df, cp.CompactMatrix):
+        return df_mean, df_std, cp.divide_compact(df_std, df_mean)
     df_cv = ms.convert_to_numerics(df_std.div(df_mean).reset_index())
     return df_mean, df_std, df_cv
 
@@ -41,6 +47,12 @@ def filter_data_with_more_than_n_reads_among_4_samples(df, agg_colname, n=0):
     all nutrient conditions when assessing a particular metabolite."""
     # Generate aggregated data to count NaN
     df_count_valid_data = ms.group_and_agg(df, colname=agg_colname, agg_type="count")
+    if isinstance(df, cp.CompactMatrix):
+        try:
+            df_count_valid_data = cp.drop_compact_samples(df_count_valid_data, ["BLANK", "CTRL"])
+        except KeyError:
+            pass
+        return cp.select_compact(df, cols=(df_count_valid_data.values >= n).all(axis=0))
     try:
         df_count_valid_data = df_count_valid_data.drop(index=["BLANK", "CTRL"])
     except:
@@ -60,6 +72,13 @@ def filter_data_with_more_than_n_reads_among_4_samples(df, agg_colname, n=0):
 def normalize_nutrient_data_to_control(df):
     """Normalizes nutrient data value to the control (GLC | AMN). Drops the control row
     after normalization and returns dataframe to caller."""
+    if isinstance(df, cp.CompactMatrix):
+        try:
+            df = cp.drop_compact_samples(df, ["BLANK", "CTRL"])
+        except KeyError:
+            pass
+        df = cp.normalize_compact_to_ref_row_in_chunks(df, df.values.shape[0], ref_row_idx=3)
+        return cp.drop_compact_samples(df, ["GLC | AMN"])
     # Remove blank row and CTRL
     try:
         df = df.drop(index=["BLANK", "CTRL"])
@@ -73,9 +92,30 @@ def normalize_nutrient_data_to_control(df):
     return df.astype(float)
 
 
-if __name__ == "__main__":
-    # Get pandas df from CSV path
-    tims_path = os.path.join(DATA_PATH, "20211104_IH_timsTOF_Experiment.csv")
+def read_bucket_mass_and_rt(tims_path):
+    """Returns neutral "Mass" and "RT" (min) of buckets in timsTOF bucket table export at
+    `tims_path`, indexed by "m/z_RT" feature labels as in pipeline outputs."""
+    df = read_csv(tims_path, usecols=["Bucket label", "RT", "m/z"]).dropna(subset=["m/z"])
+    df.index = df["m/z"].astype(str) + "_" + df["RT"].astype(str)
+    # "Bucket label" holds the software-assigned neutral mass, e.g. "127.01123 Da 38.56 s" -
+    # buckets are not all [M+H]+, so it can't be derived from m/z
+    df["Mass"] = df["Bucket label"].str.split(" ", n=1).str[0].astype(float)
+    return df.loc[~df.index.duplicated(keep="first"), ["Mass", "RT"]]
+
+
+def read_and_normalize_nutrient_data(
+    tims_path,
+    chunk_size=6,
+    n=2,
+    collapse_isotopes=False,
+    isotope_ppm=10,
+    isotope_rt_window=0.05,
+    compact=False,
+):
+    """Reads timsTOF bucket table export at `tims_path` and normalizes metabolite levels
+    within each biological replicate of `chunk_size` samples. If `collapse_isotopes`, keeps
+    one representative feature per isotope / adduct group (see `dataproc.annotate`). If
+    `compact`, returns a CompactMatrix with 0.0 readings as missing (see `dataproc.compact`)."""
     tims_df = read_csv(tims_path)
     tims_df = ms.mv_row_as_header(tims_df, row_idx=0)
     tims_df["Sample Group"] = tims_df.iloc[:, 2].astype(str) + "_" + tims_df.iloc[:, 1].astype(str)
@@ -97,17 +137,131 @@ if __name__ == "__main__":
     )
     tims_df_trunc = ms.mv_row_as_header(tims_df_trunc, row_idx=28).set_index("Sample Group")
 
-    # Convert "0.0" readings to NaN
-    tims_df_trunc = ms.convert_value_to_nan(tims_df_trunc, "0.0")
-    tims_df_trunc = normalize_metabolite_levels_within_biological_replicate(tims_df_trunc, 6)
+    if compact:
+        # Held as float32 (sparse, if mostly 0.0) with 0.0 readings as missing cells
+        tims_df_trunc = cp.df_to_compact(ms.convert_to_numerics(tims_df_trunc), missing_value=0.0)
+    else:
+        # Convert "0.0" readings to NaN
+        tims_df_trunc = ms.convert_value_to_nan(tims_df_trunc, "0.0")
+    if collapse_isotopes:
+        # Imported here - scipy is only needed for isotope grouping
+        import dataproc.annotate as an
 
-    # Begin aggregating and normalizing aggregated results to control value (GLC | AMN)
-    agg_nutrient_mean, _, _ = aggregate_mean_std_cv_from_nutrient_data(tims_df_trunc)
-    norm_agg_nutrient_mean = normalize_nutrient_data_to_control(agg_nutrient_mean).dropna(axis=1)
+        tims_df_trunc = an.collapse_isotope_and_adduct_features(
+            tims_df_trunc if compact else ms.convert_to_numerics(tims_df_trunc),
+            ppm=isotope_ppm,
+            rt_window=isotope_rt_window,
+        )
+    return normalize_metabolite_levels_within_biological_replicate(tims_df_trunc, chunk_size, n=n)
+
+
+def get_log2_from_agg_nutrient_data(agg_nutrient_data, log2_weight=4, range_min=-5, range_max=10):
+    """Normalizes aggregated mean data (first of (mean, std, cv) `agg_nutrient_data`) to the
+    control and keeps log2 values greater than log2_weight, within (range_min, range_max)."""
+    agg_nutrient_mean, _, _ = agg_nutrient_data
+    norm_agg_nutrient_mean = ms.drop_cols_with_nan(
+        normalize_nutrient_data_to_control(agg_nutrient_mean)
+    )
     norm_agg_nutrient_mean_log2 = ms.get_log2_df_directional(
-        norm_agg_nutrient_mean, downregulated=False, log2_weight=4
+        norm_agg_nutrient_mean, downregulated=False, log2_weight=log2_weight
+    )
+    norm_agg_nutrient_mean_log2 = ms.get_df_values_within_range(
+        norm_agg_nutrient_mean_log2, range_min, range_max
     )
-    norm_agg_nutrient_mean_log2 = ms.get_df_values_within_range(norm_agg_nutrient_mean_log2, -5, 10)
+    return ms.to_df(norm_agg_nutrient_mean_log2)
+
+
+def get_log2_all_from_agg_nutrient_data(agg_nutrient_data):
+    """Returns log2 of aggregated mean data normalized to the control, for every metabolite."""
+    agg_nutrient_mean, _, _ = agg_nutrient_data
+    return np.log2(ms.to_df(normalize_nutrient_data_to_control(agg_nutrient_mean)).dropna(axis=1))
+
+
+def get_normalize_params(chunk_size, n, collapse_isotopes, isotope_ppm, isotope_rt_window, compact):
+    """Returns params of `read_and_normalize_nutrient_data`. Isotope params are only included
+    (and so only part of the cache key) when `collapse_isotopes` is set, as they are unused
+    otherwise. `compact` is only included when set."""
+    params = {"chunk_size": chunk_size, "n": n}
+    if collapse_isotopes:
+        params.update(
+            collapse_isotopes=True, isotope_ppm=isotope_ppm, isotope_rt_window=isotope_rt_window
+        )
+    if compact:
+        params["compact"] = True
+    return params
+
+
+def get_agg_stages(
+    chunk_size=6,
+    n=2,
+    collapse_isotopes=False,
+    isotope_ppm=10,
+    isotope_rt_window=0.05,
+    compact=False,
+):
+    """Returns normalization and aggregation stages for `result_cache.run_stages`."""
+    normalize_params = get_normalize_params(
+        chunk_size, n, collapse_isotopes, isotope_ppm, isotope_rt_window, compact
+    )
+    return [
+        ("timsTOF_normalize", read_and_normalize_nutrient_data, normalize_params),
+        ("timsTOF_aggregate", aggregate_mean_std_cv_from_nutrient_data, {"n": n}),
+    ]
+
+
+def get_norm_agg_nutrient_mean_log2(
+    tims_path,
+    chunk_size=6,
+    n=2,
+    log2_weight=4,
+    range_min=-5,
+    range_max=10,
+    cache=None,
+    collapse_isotopes=False,
+    isotope_ppm=10,
+    isotope_rt_window=0.05,
+    compact=False,
+):
+    """Runs the timsTOF pipeline on bucket table export at `tims_path`.
+    Returns log2 transformed nutrient means normalized to the control (GLC | AMN).
+    Stage results are memoized in `cache` (a `result_cache.ResultCache`), if given.
+    If `collapse_isotopes`, isotope / adduct features are collapsed before normalization.
+    If `compact`, intensities are held in compact storage (see `dataproc.compact`)."""
+    stages = get_agg_stages(
+        chunk_size, n, collapse_isotopes, isotope_ppm, isotope_rt_window, compact
+    ) + [
+        (
+            "timsTOF_log2",
+            get_log2_from_agg_nutrient_data,
+            {"log2_weight": log2_weight, "range_min": range_min, "range_max": range_max},
+        ),
+    ]
+    return result_cache.run_stages(tims_path, stages, cache=cache)
+
+
+def get_norm_agg_nutrient_mean_log2_all(
+    tims_path,
+    chunk_size=6,
+    n=2,
+    cache=None,
+    collapse_isotopes=False,
+    isotope_ppm=10,
+    isotope_rt_window=0.05,
+    compact=False,
+):
+    """As `get_norm_agg_nutrient_mean_log2`, without log2_weight or range filtering."""
+    stages = get_agg_stages(
+        chunk_size, n, collapse_isotopes, isotope_ppm, isotope_rt_window, compact
+    ) + [
+        ("timsTOF_log2_all", get_log2_all_from_agg_nutrient_data, {}),
+    ]
+    return result_cache.run_stages(tims_path, stages, cache=cache)
+
+
+if __name__ == "__main__":
+    # Get pandas df from CSV path
+    tims_path = os.path.join(DATA_PATH, "20211104_IH_timsTOF_Experiment.csv")
+    norm_agg_nutrient_mean_log2 = get_norm_agg_nutrient_mean_log2(tims_path)
 
     # Export data as CSV for further analysis
     norm_agg_nutrient_mean_log2.to_csv(os.path.join(DATA_PATH, "log2_nutrient_mean_timsTOF.csv"))
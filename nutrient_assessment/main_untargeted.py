@@ -25,15 +25,12 @@ montenegro-burke-ms/nutrient_assessment/data/log2_nutrient_mean.csv
 
 import os
 
-import seaborn as sns
-
-from dataproc import read_csv
+from dataproc import read_csv_with_cols_to_keep
 import dataproc.untargeted_ms as ms
 
 BASE_PATH = os.path.abspath(os.path.dirname(__file__))
 DATA_PATH = os.path.join(BASE_PATH, "data")
 FIGURES_PATH = os.path.join(BASE_PATH, "figures")
-sns.set_theme()
 
 
 def isolate_cols_and_transpose_df(df, col_substrings):
@@ -125,11 +122,19 @@ def normalize_nutrient_data_to_control(df):
 
 
 if __name__ == "__main__":
+    # Imported here - seaborn is slow to import and unused by the functions above
+    import seaborn as sns
+
+    sns.set_theme()
+
     # Get pandas df from CSV path
     untargeted_yeast_ms_path = os.path.join(
         DATA_PATH, "exportFile_irahorecka_yeast_nutrient_array_350milliminute_retention_time.csv"
     )
-    untargeted_yeast_ms_df = read_csv(untargeted_yeast_ms_path)
+    # Only parse columns used downstream - export holds [Mass], [RT], [Area], etc. per injection
+    untargeted_yeast_ms_df = read_csv_with_cols_to_keep(
+        untargeted_yeast_ms_path, ["Compound Name", "Area"], float_col_substrings=["Area"]
+    )
 
     # Try below two expressions to read 350milliminute retention time file.
     # These samples contain _REF or _MET suffix for values in column "Compound Name".
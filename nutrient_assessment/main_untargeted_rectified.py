@@ -11,8 +11,12 @@ biosynthesis pathway. However, this alone should not be enough reason to begin u
 
 import os
 
-from dataproc import read_csv
+import numpy as np
+
+from dataproc import read_csv, read_csv_with_cols_to_keep
+import dataproc.compact as cp
 import dataproc.untargeted_ms as ms
+import result_cache
 
 BASE_PATH = os.path.abspath(os.path.dirname(__file__))
 DATA_PATH = os.path.join(BASE_PATH, "data")
@@ -50,25 +54,29 @@ def mutate_and_relabel_nutrient_data(df, src_colname, dest_colname="Sample Group
 
 
 def normalize_metabolite_levels_within_biological_replicate(df, chunk_size):
-    """Normalizes metabolite levels to the control (GLC | AMN) within each biological replicate."""
+    """Normalizes metabolite levels to the control (GLC | AMN) within each biological replicate.
+    A CompactMatrix (samples labeled by "Sample Group") is normalized in compact storage."""
+    if isinstance(df, cp.CompactMatrix):
+        df = filter_data_with_more_than_3_reads_among_4_samples(df, "Sample Group")
+        df = cp.drop_compact_samples(df, ["Blank", "CTRL"])
+        return ms.normalize_df_to_ref_row_in_chunks(df, chunk_size, ref_row_idx=3)
     df = ms.convert_to_numerics(df).set_index("Sample Group")
     df = filter_data_with_more_than_3_reads_among_4_samples(df, "Sample Group").drop(
         index=["Blank", "CTRL"]
     )
-    df_concat = ms.get_empty_df_from_df(df)
-    list_df = [df[i : i + chunk_size] for i in range(0, df.shape[0], chunk_size)]
-    for df_ in list_df:
-        df_.loc[:, df_.columns[0] :] = df_.loc[:, df_.columns[0] :].div(
-            df_.iloc[3][df_.columns[0] :]
-        )
-        df_concat = ms.concat_df(df_concat, df_, axis=0)
-
-    return df_concat.reset_index().rename(columns={"index": "Sample Group"})
+    # Divide each biological replicate (chunk) by its control row in a single copy of df
+    df = ms.normalize_df_to_ref_row_in_chunks(df, chunk_size, ref_row_idx=3)
+    return df.reset_index().rename(columns={"index": "Sample Group"})
 
 
 def aggregate_mean_std_cv_from_nutrient_data(df, agg_colname="Sample Group"):
     """Aggregates dataframe to find mean, std, and cv, grouping by column
     bound to `agg_colname`. Returns all three aggregated dataframes to caller."""
+    if isinstance(df, cp.CompactMatrix):
+        df = filter_data_with_more_than_3_reads_among_4_samples(df, agg_colname)
+        df_mean = ms.group_and_agg(df, colname=agg_colname, agg_type="mean")
+        df_std = ms.group_and_agg(df, colname=agg_colname, agg_type="std")
+        return df_mean, df_std, cp.divide_compact(df_std, df_mean)
     df = ms.convert_to_numerics(df)
     df = filter_data_with_more_than_3_reads_among_4_samples(df, agg_colname)
     # Begin aggregation
@@ -84,6 +92,12 @@ def filter_data_with_more_than_3_reads_among_4_samples(df, agg_colname):
     all nutrient conditions when assessing a particular metabolite."""
     # Generate aggregated data to count NaN
     df_count_valid_data = ms.group_and_agg(df, colname=agg_colname, agg_type="count")
+    if isinstance(df, cp.CompactMatrix):
+        try:
+            df_count_valid_data = cp.drop_compact_samples(df_count_valid_data, ["Blank", "CTRL"])
+        except KeyError:
+            pass
+        return cp.select_compact(df, cols=(df_count_valid_data.values >= 3).all(axis=0))
     try:
         df_count_valid_data = df_count_valid_data.drop(index=["Blank", "CTRL"])
     except:
@@ -116,6 +130,13 @@ def filter_mean_data_from_control_cv_threshold(df_mean, df_cv, cv_threshold=0.15
 def normalize_nutrient_data_to_control(df):
     """Normalizes nutrient data value to the control (GLC | AMN). Drops the control row
     after normalization and returns dataframe to caller."""
+    if isinstance(df, cp.CompactMatrix):
+        try:
+            df = cp.drop_compact_samples(df, ["Blank", "CTRL"])
+        except KeyError:
+            pass
+        df = cp.normalize_compact_to_ref_row_in_chunks(df, df.values.shape[0], ref_row_idx=3)
+        return cp.drop_compact_samples(df, ["GLC | AMN"])
     # Remove blank row and CTRL
     try:
         df = df.drop(index=["Blank", "CTRL"])
@@ -129,20 +150,34 @@ def normalize_nutrient_data_to_control(df):
     return df.astype(float)
 
 
-if __name__ == "__main__":
-    # Get pandas df from CSV path
-    untargeted_yeast_ms_path = os.path.join(
-        DATA_PATH, "exportFile_irahorecka_yeast_nutrient_array_350milliminute_retention_time.csv"
-    )
-    untargeted_yeast_ms_df = read_csv(untargeted_yeast_ms_path)
-
+def drop_ref_compounds(df):
+    """Drops _REF compounds and strips _MET suffix from "Compound Name", if present."""
     # Try below two expressions to read 350milliminute retention time file.
     # These samples contain _REF or _MET suffix for values in column "Compound Name".
-    if untargeted_yeast_ms_df["Compound Name"].str[-3:].str.contains("MET").any():
-        untargeted_yeast_ms_df = ms.drop_rows_with_substring_in_col_value(
-            untargeted_yeast_ms_df, "Compound Name", "REF"
-        )
-        untargeted_yeast_ms_df["Compound Name"] = untargeted_yeast_ms_df["Compound Name"].str[:-4]
+    if df["Compound Name"].str[-3:].str.contains("MET").any():
+        df = ms.drop_rows_with_substring_in_col_value(df, "Compound Name", "REF")
+        df["Compound Name"] = df["Compound Name"].str[:-4]
+    return df
+
+
+def read_compound_mass_and_rt(untargeted_yeast_ms_path):
+    """Returns neutral "Mass" and "RT" (min) of compounds in MassHunter export at
+    `untargeted_yeast_ms_path`, indexed by compound name as in pipeline outputs."""
+    df = read_csv(untargeted_yeast_ms_path, usecols=["Compound Name", "Mass", "RT"])
+    df = drop_ref_compounds(df).drop_duplicates(subset="Compound Name", keep="first")
+    return df.set_index("Compound Name")
+
+
+def read_and_normalize_nutrient_data(untargeted_yeast_ms_path, chunk_size=6, compact=False):
+    """Reads MassHunter export at `untargeted_yeast_ms_path` and normalizes metabolite levels
+    within each biological replicate of `chunk_size` samples. If `compact`, returns a
+    CompactMatrix (see `dataproc.compact`)."""
+    # Only parse columns used downstream - export holds [Mass], [RT], [Area], etc. per injection
+    untargeted_yeast_ms_df = read_csv_with_cols_to_keep(
+        untargeted_yeast_ms_path, ["Compound Name", "Area"], float_col_substrings=["Area"]
+    )
+
+    untargeted_yeast_ms_df = drop_ref_compounds(untargeted_yeast_ms_df)
 
     # Manipulate df for aggregation
     untargeted_yeast_ms_df = isolate_cols_and_transpose_df(
@@ -151,15 +186,20 @@ if __name__ == "__main__":
     untargeted_yeast_ms_df = mutate_and_relabel_nutrient_data(
         untargeted_yeast_ms_df, src_colname="Compound Name"
     )
-
-    untargeted_yeast_ms_df = normalize_metabolite_levels_within_biological_replicate(
-        untargeted_yeast_ms_df, 6
+    if compact:
+        # Held as float32 from here on - the float64 df is dropped once converted
+        untargeted_yeast_ms_df = cp.df_to_compact(
+            ms.convert_to_numerics(untargeted_yeast_ms_df).set_index("Sample Group")
+        )
+    return normalize_metabolite_levels_within_biological_replicate(
+        untargeted_yeast_ms_df, chunk_size
     )
 
-    # Aggregate df and find normalized values in respect to the control
-    agg_nutrient_mean, agg_nutrient_std, agg_nutrient_cv = aggregate_mean_std_cv_from_nutrient_data(
-        untargeted_yeast_ms_df
-    )
+
+def get_log2_from_agg_nutrient_data(agg_nutrient_data, log2_weight=1, range_min=-5, range_max=5):
+    """Normalizes aggregated mean data (first of (mean, std, cv) `agg_nutrient_data`) to the
+    control and keeps log2 values greater than log2_weight, within (range_min, range_max)."""
+    agg_nutrient_mean, agg_nutrient_std, agg_nutrient_cv = agg_nutrient_data
 
     # Only look at metabolites where the CV % for the control is < 15%
     # agg_nutrient_mean = filter_mean_data_from_control_cv_threshold(
@@ -169,9 +209,70 @@ if __name__ == "__main__":
     # Normalize aggregated mean data to mean of control - perform log2 scaling of results
     norm_agg_nutrient_mean = normalize_nutrient_data_to_control(agg_nutrient_mean)
     norm_agg_nutrient_mean_log2 = ms.get_log2_df_directional(
-        norm_agg_nutrient_mean, downregulated=False, log2_weight=1
+        norm_agg_nutrient_mean, downregulated=False, log2_weight=log2_weight
+    )
+    norm_agg_nutrient_mean_log2 = ms.get_df_values_within_range(
+        norm_agg_nutrient_mean_log2, range_min, range_max
+    )
+    return ms.to_df(norm_agg_nutrient_mean_log2)
+
+
+def get_log2_all_from_agg_nutrient_data(agg_nutrient_data):
+    """Returns log2 of aggregated mean data normalized to the control, for every metabolite."""
+    agg_nutrient_mean, _, _ = agg_nutrient_data
+    return np.log2(ms.to_df(normalize_nutrient_data_to_control(agg_nutrient_mean)))
+
+
+def get_agg_stages(chunk_size=6, compact=False):
+    """Returns normalization and aggregation stages for `result_cache.run_stages`."""
+    normalize_params = {"chunk_size": chunk_size}
+    if compact:
+        normalize_params["compact"] = True
+    return [
+        ("untargeted_normalize", read_and_normalize_nutrient_data, normalize_params),
+        ("untargeted_aggregate", aggregate_mean_std_cv_from_nutrient_data, {}),
+    ]
+
+
+def get_norm_agg_nutrient_mean_log2(
+    untargeted_yeast_ms_path,
+    chunk_size=6,
+    log2_weight=1,
+    range_min=-5,
+    range_max=5,
+    cache=None,
+    compact=False,
+):
+    """Runs the untargeted pipeline on MassHunter export at `untargeted_yeast_ms_path`.
+    Returns log2 transformed nutrient means normalized to the control (GLC | AMN).
+    Stage results are memoized in `cache` (a `result_cache.ResultCache`), if given.
+    If `compact`, intensities are held in compact storage (see `dataproc.compact`)."""
+    stages = get_agg_stages(chunk_size, compact) + [
+        (
+            "untargeted_log2",
+            get_log2_from_agg_nutrient_data,
+            {"log2_weight": log2_weight, "range_min": range_min, "range_max": range_max},
+        ),
+    ]
+    return result_cache.run_stages(untargeted_yeast_ms_path, stages, cache=cache)
+
+
+def get_norm_agg_nutrient_mean_log2_all(
+    untargeted_yeast_ms_path, chunk_size=6, cache=None, compact=False
+):
+    """As `get_norm_agg_nutrient_mean_log2`, without log2_weight or range filtering."""
+    stages = get_agg_stages(chunk_size, compact) + [
+        ("untargeted_log2_all", get_log2_all_from_agg_nutrient_data, {}),
+    ]
+    return result_cache.run_stages(untargeted_yeast_ms_path, stages, cache=cache)
+
+
+if __name__ == "__main__":
+    # Get pandas df from CSV path
+    untargeted_yeast_ms_path = os.path.join(
+        DATA_PATH, "exportFile_irahorecka_yeast_nutrient_array_350milliminute_retention_time.csv"
     )
-    norm_agg_nutrient_mean_log2 = ms.get_df_values_within_range(norm_agg_nutrient_mean_log2, -5, 5)
+    norm_agg_nutrient_mean_log2 = get_norm_agg_nutrient_mean_log2(untargeted_yeast_ms_path)
 
     # Export data as CSV for further analysis
     norm_agg_nutrient_mean_log2.to_csv(os.path.join(DATA_PATH, "log2_nutrient_mean.csv"))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import nutrient_assessment modules as the scripts do, e.g. `import dataproc.matrix`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
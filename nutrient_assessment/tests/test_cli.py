@@ -0,0 +1,47 @@
+"""
+montenegro-burke-ms/nutrient_assessment/tests/test_cli.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Cold-start budget of `cli.py`: `--help` and `validate` must not import the
+heavy scientific libraries, and their total import time (from
+`python -X importtime`) must stay under IMPORT_TIME_BUDGET_S.
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TIMSTOF_PATH = os.path.join(BASE_PATH, "data", "20211104_IH_timsTOF_Experiment.csv")
+# Measured at about 0.1 s - leaves room for slower machines
+IMPORT_TIME_BUDGET_S = 0.5
+HEAVY_MODULES = {"pandas", "numpy", "scipy", "matplotlib", "seaborn", "pyarrow"}
+
+
+def get_imported_modules(args):
+    """Runs `python -X importtime cli.py *args` and returns {module name: self time (us)}."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "cli.py", *args],
+        cwd=BASE_PATH,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imported_modules = {}
+    # Lines look like "import time:       276 |        276 |     multiprocessing.queues"
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        imported_modules[name.strip()] = int(self_us)
+    return imported_modules
+
+
+@pytest.mark.parametrize("args", [["--help"], ["validate", TIMSTOF_PATH]], ids=["help", "validate"])
+def test_cold_start(args):
+    imported_modules = get_imported_modules(args)
+    heavy_modules = {name for name in imported_modules if name.split(".")[0] in HEAVY_MODULES}
+    assert not heavy_modules
+    assert sum(imported_modules.values()) / 1e6 < IMPORT_TIME_BUDGET_S
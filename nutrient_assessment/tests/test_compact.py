@@ -0,0 +1,129 @@
+"""
+montenegro-burke-ms/nutrient_assessment/tests/test_compact.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Checks that compact storage (`dataproc.compact`) agrees with the float64
+functions within `RTOL`, in dense and sparse storage and end to end through
+the rectified pipelines.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import dataproc.compact as cp
+import dataproc.untargeted_ms as ms
+import main_timsTOF_rectified as mt
+import main_untargeted_rectified as mu
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+UNTARGETED_PATH = os.path.join(
+    DATA_PATH, "exportFile_irahorecka_yeast_nutrient_array_350milliminute_retention_time.csv"
+)
+TIMSTOF_PATH = os.path.join(DATA_PATH, "20211104_IH_timsTOF_Experiment.csv")
+CHUNK_SIZE = 6
+
+
+def get_intensity_df(missing_fraction, n_samples=24, n_features=300, seed=0):
+    """Returns df of intensities with `missing_fraction` of cells NaN, labeled by 4 groups."""
+    rng = np.random.default_rng(seed)
+    values = rng.lognormal(mean=10, sigma=1, size=(n_samples, n_features))
+    values[rng.random(values.shape) < missing_fraction] = np.nan
+    samples = pd.Index(np.tile(["A", "B", "C", "D"], n_samples // 4), name="Sample Group")
+    return pd.DataFrame(values, index=samples, columns=[f"feature_{i}" for i in range(n_features)])
+
+
+@pytest.fixture(params=[False, True], ids=["dense", "sparse"])
+def sparse_storage(request):
+    return request.param
+
+
+def test_round_trip(sparse_storage):
+    df = get_intensity_df(0.5)
+    compact = cp.df_to_compact(df, sparse_storage=sparse_storage)
+    assert cp.is_sparse(compact) == sparse_storage
+    pd.testing.assert_frame_equal(cp.compact_to_df(compact), df, rtol=cp.RTOL)
+
+
+def test_missing_value():
+    df = get_intensity_df(0.5).fillna(0.0)
+    compact = cp.df_to_compact(df, missing_value=0.0)
+    assert cp.is_sparse(compact) == ((df.to_numpy() != 0).mean() < cp.SPARSE_DENSITY_THRESHOLD)
+    pd.testing.assert_frame_equal(
+        cp.compact_to_df(compact), ms.convert_value_to_nan(df, 0.0), rtol=cp.RTOL
+    )
+
+
+@pytest.mark.parametrize("agg_type", ["count", "mean", "std"])
+def test_group_and_agg(sparse_storage, agg_type):
+    df = get_intensity_df(0.5)
+    compact = cp.df_to_compact(df, sparse_storage=sparse_storage)
+    expected = ms.group_and_agg(df, "Sample Group", agg_type)
+    result = cp.compact_to_df(ms.group_and_agg(compact, "Sample Group", agg_type))
+    if agg_type == "std":
+        # Within RTOL of the group mean - see dataproc.compact
+        atol = cp.RTOL * ms.group_and_agg(df, "Sample Group", "mean").abs()
+        np.testing.assert_array_equal(result.isna(), expected.isna())
+        assert ((result - expected).abs().fillna(0) <= atol.fillna(0)).all(axis=None)
+    else:
+        pd.testing.assert_frame_equal(result, expected, rtol=cp.RTOL, check_dtype=False)
+
+
+def test_normalize_to_ref_row_in_chunks(sparse_storage):
+    df = get_intensity_df(0.5)
+    compact = cp.df_to_compact(df, sparse_storage=sparse_storage)
+    pd.testing.assert_frame_equal(
+        cp.compact_to_df(ms.normalize_df_to_ref_row_in_chunks(compact, CHUNK_SIZE, 2)),
+        ms.normalize_df_to_ref_row_in_chunks(df, CHUNK_SIZE, 2),
+        rtol=cp.RTOL,
+    )
+
+
+def test_log2_and_range(sparse_storage):
+    # Fold changes around 1 in 5 conditions, as normalized group means
+    rng = np.random.default_rng(0)
+    values = rng.lognormal(mean=0, sigma=0.7, size=(5, 300))
+    values[rng.random(values.shape) < 0.02] = np.nan
+    df = pd.DataFrame(values, columns=[f"feature_{i}" for i in range(values.shape[1])])
+    compact = cp.df_to_compact(df, sparse_storage=sparse_storage)
+    for func, kwargs in (
+        (ms.get_log2_df, {"log2_weight": 1}),
+        (ms.get_log2_df_directional, {"log2_weight": 1}),
+        (ms.get_log2_df_directional, {"log2_weight": 1, "downregulated": True}),
+    ):
+        expected = ms.get_df_values_within_range(func(df, **kwargs), -2, 2)
+        result = ms.to_df(ms.get_df_values_within_range(func(compact, **kwargs), -2, 2))
+        assert not expected.empty
+        pd.testing.assert_frame_equal(result, expected, rtol=0, atol=cp.LOG2_ATOL)
+
+
+def test_dropna(sparse_storage):
+    df = get_intensity_df(0.01)
+    compact = cp.df_to_compact(df, sparse_storage=sparse_storage)
+    pd.testing.assert_frame_equal(
+        ms.to_df(ms.drop_cols_with_nan(compact)), ms.drop_cols_with_nan(df), rtol=cp.RTOL
+    )
+
+
+@pytest.mark.parametrize(
+    "func, path",
+    [
+        (mu.get_norm_agg_nutrient_mean_log2, UNTARGETED_PATH),
+        (mu.get_norm_agg_nutrient_mean_log2_all, UNTARGETED_PATH),
+        (mt.get_norm_agg_nutrient_mean_log2, TIMSTOF_PATH),
+        (mt.get_norm_agg_nutrient_mean_log2_all, TIMSTOF_PATH),
+    ],
+)
+def test_pipeline(func, path):
+    pd.testing.assert_frame_equal(func(path, compact=True), func(path), rtol=0, atol=cp.LOG2_ATOL)
+
+
+def test_pipeline_keeps_compact_storage():
+    normalized = mt.read_and_normalize_nutrient_data(TIMSTOF_PATH, compact=True)
+    assert isinstance(normalized, cp.CompactMatrix)
+    agg_mean, agg_std, agg_cv = mt.aggregate_mean_std_cv_from_nutrient_data(normalized)
+    for compact in (agg_mean, agg_std, agg_cv):
+        assert isinstance(compact, cp.CompactMatrix)
+        assert compact.values.dtype == np.float32
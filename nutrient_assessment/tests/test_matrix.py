@@ -0,0 +1,113 @@
+"""
+montenegro-burke-ms/nutrient_assessment/tests/test_matrix.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Copy-count and allocation checks of `dataproc.matrix`, so that a change
+reintroducing per-chunk copies is caught.
+"""
+
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import dataproc.matrix as mx
+import dataproc.untargeted_ms as ms
+
+CHUNK_SIZE = 6
+REF_ROW_IDX = 2
+
+
+def get_intensity_df(n_samples=240, n_features=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.uniform(1, 1000, size=(n_samples, n_features))
+    return pd.DataFrame(
+        values,
+        index=[f"sample_{i}" for i in range(n_samples)],
+        columns=[f"feature_{i}" for i in range(n_features)],
+    )
+
+
+def normalize_df_to_ref_row_in_chunks_concat(df, chunk_size, ref_row_idx):
+    """Chunk-wise `concat_df` normalization replaced by `normalize_df_to_ref_row_in_chunks`."""
+    df_concat = ms.get_empty_df_from_df(df)
+    list_df = [df[i : i + chunk_size].copy() for i in range(0, df.shape[0], chunk_size)]
+    for df_ in list_df:
+        df_.loc[:, df_.columns[0] :] = df_.loc[:, df_.columns[0] :].div(
+            df_.iloc[ref_row_idx][df_.columns[0] :]
+        )
+        df_concat = ms.concat_df(df_concat, df_, axis=0)
+    return df_concat
+
+
+def get_peak_bytes(func, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+@pytest.mark.parametrize(
+    "get_df",
+    [
+        get_intensity_df,
+        # Consolidated blocks (df.copy(), read_csv, concat, groupby) are F-ordered
+        lambda: get_intensity_df().copy(),
+        lambda: pd.concat([get_intensity_df(n_samples=120)] * 2),
+    ],
+    ids=["ndarray", "copy", "concat"],
+)
+def test_df_to_values_does_not_copy(get_df):
+    df = get_df()
+    values, _, _ = mx.df_to_values(df)
+    assert np.shares_memory(values, df.to_numpy())
+    values_copy, _, _ = mx.df_to_values(df, copy=True)
+    assert not np.shares_memory(values_copy, df.to_numpy())
+
+
+def test_normalize_values_to_ref_row_in_chunks_in_place():
+    values = get_intensity_df().to_numpy(copy=True)
+    expected = values / np.repeat(values[REF_ROW_IDX::CHUNK_SIZE], CHUNK_SIZE, axis=0)
+    out = mx.normalize_values_to_ref_row_in_chunks(values, CHUNK_SIZE, REF_ROW_IDX)
+    assert out is values
+    np.testing.assert_allclose(values, expected)
+
+
+def test_normalize_values_to_ref_row_in_chunks_out():
+    values = get_intensity_df().to_numpy(copy=True)
+    values_before = values.copy()
+    out = np.empty_like(values)
+    result = mx.normalize_values_to_ref_row_in_chunks(values, CHUNK_SIZE, REF_ROW_IDX, out=out)
+    assert result is out
+    np.testing.assert_array_equal(values, values_before)
+
+
+def test_convert_value_to_nan_in_place():
+    values = np.array([[0.0, 1.0], [2.0, 0.0]])
+    out = mx.convert_value_to_nan(values, 0.0)
+    assert out is values
+    np.testing.assert_array_equal(np.isnan(values), [[True, False], [False, True]])
+
+
+def test_normalize_df_to_ref_row_in_chunks_matches_concat():
+    df = get_intensity_df(n_samples=24, n_features=50)
+    pd.testing.assert_frame_equal(
+        ms.normalize_df_to_ref_row_in_chunks(df, CHUNK_SIZE, REF_ROW_IDX),
+        normalize_df_to_ref_row_in_chunks_concat(df, CHUNK_SIZE, REF_ROW_IDX).astype(np.float64),
+    )
+
+
+def test_normalize_df_to_ref_row_in_chunks_peak_memory():
+    df = get_intensity_df()
+    nbytes = df.to_numpy().nbytes
+    peak = get_peak_bytes(ms.normalize_df_to_ref_row_in_chunks, df, CHUNK_SIZE, REF_ROW_IDX)
+    peak_concat = get_peak_bytes(
+        normalize_df_to_ref_row_in_chunks_concat, df, CHUNK_SIZE, REF_ROW_IDX
+    )
+    # A single output copy of df, plus small per-chunk temporaries
+    assert peak < 1.25 * nbytes
+    assert peak < peak_concat
@@ -0,0 +1,59 @@
+"""
+montenegro-burke-ms/nutrient_assessment/tests/test_watch_service.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+End-to-end check of `watch_service.WatchService` against a temporary input
+directory.
+"""
+
+import asyncio
+import os
+import shutil
+
+import pandas as pd
+
+import watch_service
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+TIMSTOF_PATH = os.path.join(DATA_PATH, "20211104_IH_timsTOF_Experiment.csv")
+TIMEOUT_S = 60
+
+
+async def run_until_jobs_finish(service, n_jobs):
+    """Runs `service` until `n_jobs` jobs left the running / pending states."""
+    service_task = asyncio.ensure_future(service.run(port=0))
+    try:
+        for _ in range(int(TIMEOUT_S / 0.1)):
+            await asyncio.sleep(0.1)
+            assert not service_task.done(), service_task.exception()
+            statuses = [job["status"] for job in service.jobs]
+            if len(statuses) == n_jobs and not {"running", "duplicate_pending"} & set(statuses):
+                return list(service.jobs)
+        raise TimeoutError(f"Jobs did not finish: {service.get_status()}")
+    finally:
+        service_task.cancel()
+        try:
+            await service_task
+        except asyncio.CancelledError:
+            pass
+
+
+def test_process_export_and_duplicate(tmp_path):
+    input_dir, output_dir = tmp_path / "exports", tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    shutil.copy(TIMSTOF_PATH, input_dir / "run_1.csv")
+    shutil.copy(TIMSTOF_PATH, input_dir / "run_2.csv")
+
+    service = watch_service.WatchService(
+        str(input_dir), str(output_dir), max_workers=1, poll_interval=0.1
+    )
+    jobs = asyncio.run(run_until_jobs_finish(service, n_jobs=2))
+
+    statuses = sorted(job["status"] for job in jobs)
+    assert statuses == ["done", "duplicate"], jobs
+    done_job, duplicate_job = sorted(jobs, key=lambda job: job["status"])
+    assert duplicate_job["duplicate_of"] == done_job["id"]
+    assert duplicate_job["output"] == done_job["output"]
+    assert os.listdir(output_dir) == [os.path.basename(done_job["output"])]
+    assert not pd.read_csv(done_job["output"], index_col=0).empty
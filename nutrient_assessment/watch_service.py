@@ -0,0 +1,250 @@
+"""
+montenegro-burke-ms/nutrient_assessment/watch_service.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A long-running local service that processes instrument exports as they land,
+instead of running `python main_timsTOF_rectified.py` by hand.
+
+    - Polls `--input-dir` for new or changed CSV exports. A file is queued once
+    its size and mtime are unchanged across two polls (i.e., export finished).
+    - Skips files whose content (SHA-256) was already processed, pointing the
+    duplicate job at the job that processed it.
+    - Runs the matching pipeline (Profinder / MassHunter untargeted export or
+    timsTOF bucket table) in a bounded process pool, recreated if a worker dies.
+    - Writes log2_nutrient_mean_<export name>.csv atomically to `--output-dir`.
+    - Serves queue depth and per-job latency as JSON at http://127.0.0.1:<port>/status
+
+Usage:
+    python watch_service.py --input-dir ~/exports --output-dir data
+"""
+
+import argparse
+import asyncio
+import collections
+import csv
+import functools
+import itertools
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from result_cache import get_file_hash
+
+BASE_PATH = os.path.abspath(os.path.dirname(__file__))
+DATA_PATH = os.path.join(BASE_PATH, "data")
+
+
+def write_csv_atomic(df, path):
+    """Writes df to `path` through a temporary file in the same directory, so readers
+    never see a partially written CSV."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            df.to_csv(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def get_export_format(path):
+    """Returns "untargeted" for Profinder / MassHunter exports and "timsTOF" for timsTOF
+    bucket tables, reading only the CSV header. Returns None if unrecognized."""
+    with open(path, newline="") as f:
+        header = next(csv.reader(f), [])
+    if "Compound Name" in header:
+        return "untargeted"
+    if "Bucket label" in header:
+        return "timsTOF"
+    return None
+
+
+def process_export(input_path, output_dir):
+    """Runs the pipeline matching the export at `input_path` and writes its log2 nutrient
+    means to `output_dir`. Runs in a worker process - pipeline modules are imported here."""
+    export_format = get_export_format(input_path)
+    if export_format == "untargeted":
+        import main_untargeted_rectified as pipeline
+    elif export_format == "timsTOF":
+        import main_timsTOF_rectified as pipeline
+    else:
+        raise ValueError(f"Unrecognized export format: {input_path}")
+
+    norm_agg_nutrient_mean_log2 = pipeline.get_norm_agg_nutrient_mean_log2(input_path)
+    output_name = f"log2_nutrient_mean_{os.path.splitext(os.path.basename(input_path))[0]}.csv"
+    output_path = os.path.join(output_dir, output_name)
+    write_csv_atomic(norm_agg_nutrient_mean_log2, output_path)
+    return output_path
+
+
+class WatchService:
+    """Watches `input_dir` and processes exports with at most `max_workers` processes."""
+
+    def __init__(self, input_dir, output_dir, max_workers=2, poll_interval=2.0, max_jobs=100):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        # Created in `run` - before Python 3.10, an asyncio.Queue binds to the event loop
+        # current at creation, which is not the loop `asyncio.run` starts
+        self.queue = None
+        # path -> (mtime_ns, size) at last poll, and of last queued version
+        self.file_stats = {}
+        self.queued_stats = {}
+        # content hash -> (id of job processing it, future of its output path - None if failed)
+        self.processed_hashes = {}
+        self.jobs = collections.deque(maxlen=max_jobs)
+        self.job_ids = itertools.count(1)
+        self.pool = None
+
+    async def run(self, host="127.0.0.1", port=8765):
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        server = await asyncio.start_server(self.handle_status_request, host, port)
+        self.pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        workers = [asyncio.create_task(self.work(loop)) for _ in range(self.max_workers)]
+        try:
+            async with server:
+                await self.watch()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.pool.shutdown()
+
+    def restart_pool(self, broken_pool):
+        """Replaces `broken_pool` (e.g. after a worker process died) unless another worker
+        already did."""
+        if self.pool is broken_pool:
+            self.pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            broken_pool.shutdown(wait=False)
+
+    async def watch(self):
+        """Polls `input_dir` and queues exports whose size and mtime settled since last poll."""
+        while True:
+            for path in self.list_exports():
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                file_stat = (stat.st_mtime_ns, stat.st_size)
+                is_settled = self.file_stats.get(path) == file_stat
+                self.file_stats[path] = file_stat
+                if is_settled and self.queued_stats.get(path) != file_stat:
+                    self.queued_stats[path] = file_stat
+                    self.queue.put_nowait((path, time.monotonic()))
+            await asyncio.sleep(self.poll_interval)
+
+    def list_exports(self):
+        return [
+            entry.path
+            for entry in os.scandir(self.input_dir)
+            if entry.is_file() and entry.name.lower().endswith(".csv")
+        ]
+
+    async def work(self, loop):
+        """Consumes queued exports - hashing and pipelines run off the event loop."""
+        while True:
+            path, queued_time = await self.queue.get()
+            job = {
+                "id": next(self.job_ids),
+                "path": path,
+                "status": "running",
+                "started_at": time.time(),
+            }
+            self.jobs.append(job)
+            try:
+                file_hash = await loop.run_in_executor(None, get_file_hash, path)
+                job["hash"] = file_hash
+                if file_hash in self.processed_hashes:
+                    job["duplicate_of"], output_future = self.processed_hashes[file_hash]
+                    # Output of the original job is filled in once it finishes
+                    job["status"] = "duplicate_pending"
+                    output_future.add_done_callback(functools.partial(self.resolve_duplicate, job))
+                    continue
+                output_future = loop.create_future()
+                self.processed_hashes[file_hash] = (job["id"], output_future)
+                pool = self.pool
+                try:
+                    job["output"] = await loop.run_in_executor(
+                        pool, process_export, path, self.output_dir
+                    )
+                except Exception as e:
+                    # Allow a retry of identical content, e.g. after fixing the pipeline
+                    del self.processed_hashes[file_hash]
+                    output_future.set_result(None)
+                    if isinstance(e, BrokenProcessPool):
+                        self.restart_pool(pool)
+                    raise
+                output_future.set_result(job["output"])
+                job["status"] = "done"
+            except Exception as e:
+                job["status"] = "failed"
+                job["error"] = f"{type(e).__name__}: {e}"
+            finally:
+                job["latency_s"] = round(time.monotonic() - queued_time, 3)
+                self.queue.task_done()
+
+    @staticmethod
+    def resolve_duplicate(job, output_future):
+        """Points duplicate `job` at the output of the job it duplicates."""
+        output = output_future.result()
+        if output is None:
+            job["status"] = "failed"
+            job["error"] = f"Job {job['duplicate_of']} processing this content failed"
+        else:
+            job["status"] = "duplicate"
+            job["output"] = output
+
+    def get_status(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "running": sum(job["status"] == "running" for job in self.jobs),
+            "jobs": list(self.jobs),
+        }
+
+    async def handle_status_request(self, reader, writer):
+        """Minimal HTTP/1.0 handler - GET /status returns `get_status` as JSON."""
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            # Drain request headers
+            while (await reader.readline()).strip():
+                pass
+            if request_line[:2] == ["GET", "/status"]:
+                status, body = "200 OK", json.dumps(self.get_status()).encode()
+            else:
+                status, body = "404 Not Found", json.dumps({"error": "not found"}).encode()
+            writer.write(
+                f"HTTP/1.0 {status}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+def add_arguments(parser):
+    parser.add_argument("--input-dir", required=True, help="Directory instruments export to")
+    parser.add_argument("--output-dir", default=DATA_PATH, help="Directory to write results to")
+    parser.add_argument("--workers", type=int, default=2, help="Max pipeline processes")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds between polls")
+    parser.add_argument("--port", type=int, default=8765, help="Port of /status endpoint")
+    return parser
+
+
+def run_service(args):
+    """Runs WatchService configured by parsed `args` until interrupted."""
+    service = WatchService(
+        args.input_dir, args.output_dir, max_workers=args.workers, poll_interval=args.poll_interval
+    )
+    try:
+        asyncio.run(service.run(port=args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser(description=__doc__.split("\n\n")[1]))
+    run_service(parser.parse_args())